@@ -0,0 +1,152 @@
+"""
+性能基准测试
+
+在不同规模的模拟送货单上测量各阶段耗时：查找文件、提取数据、透视汇总、
+写入合并文件和生成对账单。结果保存为JSON，便于跟踪性能变化。
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout, redirect_stderr
+from pathlib import Path
+
+import pandas as pd
+
+from generate_sample_data import generate_sample_data
+from merge_delivery_orders import (
+    find_excel_files, extract_all_files, build_detail_frame, build_aggregation_cube,
+    build_pivot_sheets, write_merged_workbook, prepare_statement_data, StatementTemplate,
+    statement_header_options,
+)
+
+
+def timed(func, *args, **kwargs):
+    """执行func，返回(耗时秒数, 返回值)；func的输出不显示"""
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+    return elapsed, result
+
+
+def record(results, benchmark, notes, seconds, items, item_name):
+    """记录一项结果并打印"""
+    entry = {
+        'benchmark': benchmark,
+        'notes': notes,
+        'seconds': round(seconds, 4),
+        item_name: items,
+        f'ms_per_{item_name}': round(seconds * 1000 / items, 4) if items else None,
+    }
+    results.append(entry)
+    print(f"  {benchmark:<20} {seconds:>9.3f}s  {items:>9} {item_name}")
+
+
+def prepare_data(data_dir, notes, workers):
+    """生成（或复用已生成的）notes张送货单，返回其目录"""
+    raw_dir = Path(data_dir) / f'notes-{notes}'
+    done_marker = raw_dir / '.complete'
+    if not done_marker.exists():
+        print(f"正在生成 {notes} 张模拟送货单...")
+        generate_sample_data(raw_dir, notes=notes, customers=max(20, notes // 50), workers=workers)
+        done_marker.touch()
+    return raw_dir
+
+
+def run_benchmarks(raw_dir, notes, workers):
+    """在raw_dir的送货单上运行所有基准测试，返回结果列表"""
+    results = []
+    print(f"\n===== {notes} 张送货单 =====")
+
+    seconds, excel_files = timed(find_excel_files, raw_dir)
+    record(results, 'discovery', notes, seconds, len(excel_files), 'file')
+    # .xls和.xlsx由不同的流式读取函数处理，记录各自的数量
+    xls_files = sum(1 for file_path in excel_files if file_path.suffix.lower() == '.xls')
+    results[-1]['xls_files'] = xls_files
+    results[-1]['xlsx_files'] = len(excel_files) - xls_files
+    print(f"  {'':<20} .xls {xls_files} 个，.xlsx {len(excel_files) - xls_files} 个")
+
+    seconds, all_data = timed(extract_all_files, excel_files, workers=1)
+    record(results, 'extract_serial', notes, seconds, len(excel_files), 'file')
+
+    if workers > 1:
+        seconds, _ = timed(extract_all_files, excel_files, workers=workers)
+        record(results, f'extract_workers_{workers}', notes, seconds, len(excel_files), 'file')
+
+    seconds, df_all = timed(build_detail_frame, all_data)
+    record(results, 'detail_frame', notes, seconds, len(df_all), 'row')
+
+    def aggregate():
+        return build_pivot_sheets(build_aggregation_cube(df_all))
+
+    seconds, sheets = timed(aggregate)
+    record(results, 'aggregation', notes, seconds, len(df_all), 'row')
+
+    df_all_sorted = df_all.sort_values(['货名', '规格', '日期'])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_file = Path(tmp_dir) / 'merged_delivery_orders.xlsx'
+        sheets = {'汇总': sheets['汇总'], '详细数据': df_all_sorted, **sheets}
+        seconds, _ = timed(write_merged_workbook, output_file, sheets)
+        record(results, 'write_merged', notes, seconds, len(df_all), 'row')
+
+        # 取行数最多的客户月份和一个中等规模的客户月份，用同一个模板生成对账单
+        df_statement = prepare_statement_data(df_all_sorted)
+        groups = df_statement.groupby(['客户', '年月'], observed=True)
+        sizes = groups.size().sort_values()
+        seconds, template = timed(StatementTemplate, **statement_header_options())
+        record(results, 'statement_template', notes, seconds, 1, 'template')
+        for label, key in (('statement_median', sizes.index[len(sizes) // 2]),
+                           ('statement_largest', sizes.index[-1])):
+            group_data = groups.get_group(key)
+            seconds, _ = timed(template.render, group_data, key[0], str(key[1]),
+                               str(Path(tmp_dir) / f'{label}.xlsx'))
+            record(results, label, notes, seconds, len(group_data), 'row')
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='送货单处理性能基准测试')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='测试的送货单数量（默认: 1000 10000 100000）')
+    parser.add_argument('--data-dir', default='bench-data',
+                        help='模拟送货单的存放目录，已生成的数据会复用（默认: bench-data）')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='并行提取的进程数（默认: CPU核心数）')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='结果文件（默认: benchmark_results.json）')
+    parser.add_argument('--allow-no-xls', action='store_true',
+                        help='模拟数据中没有.xls文件时仍然运行（结果中xls_files为0）')
+    args = parser.parse_args()
+
+    results = []
+    for notes in args.sizes:
+        raw_dir = prepare_data(args.data_dir, notes, args.workers)
+        if not args.allow_no_xls and not any(raw_dir.rglob('*.xls')):
+            # 没有.xls文件时.xls的流式读取不会被测量
+            print(f"{raw_dir} 中没有.xls文件：请用 uv sync 安装开发依赖（xlwt）后删除该目录重新生成，"
+                  f"或使用 --allow-no-xls")
+            sys.exit(1)
+        results.extend(run_benchmarks(raw_dir, notes, args.workers))
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'workers': args.workers,
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存到 {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""
+送货明细台账：把提取的送货明细保存在SQLite数据库中
+
+台账与ExtractCache的接口相同（lookup/store/prune/fingerprint/save），可作为merge_delivery_orders的
+cache参数：重新运行时只解析并更新变化的文件。明细表按客户、月份、货名规格和来源文件建有索引，
+透视分析和对账单可直接从台账查询数据，无需读取合并后的Excel文件。
+
+也可从台账直接生成单个客户月份的对账单，不扫描原始数据，也不读取合并文件：
+    uv run delivery_ledger.py 客户A 2023-01 --ledger output/delivery_ledger.sqlite
+"""
+import time
+
+# 命令行显示的用时从这里算起，包括加载pandas和openpyxl的时间（通常占总用时的大部分）
+_STARTED = time.perf_counter()
+
+import argparse
+import datetime
+import os
+import sqlite3
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+from merge_delivery_orders import (
+    EXTRACT_CACHE_VERSION, DETAIL_COLUMNS, STATEMENT_COLUMNS, build_detail_frame, file_cache_key,
+    file_digest, file_signature, files_fingerprint, month_of_date, prepare_statement_data,
+    create_statement, statement_fingerprint, statement_output_file, statement_title_month, StatementManifest,
+    statement_header_options,
+)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    file_id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lines (
+    file_id INTEGER NOT NULL,
+    line_no INTEGER NOT NULL,
+    货名 TEXT,
+    规格 TEXT,
+    数量 REAL,
+    单位 TEXT,
+    单价 REAL,
+    金额 REAL,
+    客户 TEXT,
+    日期 ,
+    日期类型 TEXT,
+    文件 TEXT,
+    月份 TEXT,
+    PRIMARY KEY (file_id, line_no)
+);
+CREATE INDEX IF NOT EXISTS lines_customer_month ON lines (客户, 月份);
+CREATE INDEX IF NOT EXISTS lines_month ON lines (月份);
+CREATE INDEX IF NOT EXISTS lines_product_spec ON lines (货名, 规格);
+'''
+
+# 日期列保存原始值，日期类型列记录其Python类型，读取时还原
+_LINE_COLUMNS = ', '.join(DETAIL_COLUMNS)
+_INSERT_LINE = (f'INSERT INTO lines (file_id, line_no, {_LINE_COLUMNS}, 日期类型, 月份) '
+                f'VALUES ({", ".join("?" * (len(DETAIL_COLUMNS) + 4))})')
+
+
+def _encode_date(value):
+    """日期单元格的值转换为(SQLite中保存的值, 类型)，读取时按类型还原"""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(), 'datetime'
+    if isinstance(value, datetime.date):
+        return value.isoformat(), 'date'
+    if isinstance(value, datetime.time):
+        return value.isoformat(), 'time'
+    if isinstance(value, bool):
+        return int(value), 'bool'
+    if isinstance(value, (int, float)):
+        return value, type(value).__name__
+    return str(value), 'str'
+
+
+def _decode_date(value, kind):
+    if kind == 'datetime':
+        return datetime.datetime.fromisoformat(value)
+    if kind == 'date':
+        return datetime.date.fromisoformat(value)
+    if kind == 'time':
+        return datetime.time.fromisoformat(value)
+    if kind == 'bool':
+        return bool(value)
+    if kind == 'int':
+        return int(value)
+    if kind == 'float':
+        return float(value)
+    return value
+
+
+def _line_values(row):
+    """数据行转换为lines表中DETAIL_COLUMNS和日期类型列的值"""
+    date, kind = _encode_date(row['日期'])
+    return (*(date if column == '日期' else row[column] for column in DETAIL_COLUMNS), kind)
+
+
+def _row_of(values):
+    """lines表中DETAIL_COLUMNS和日期类型列的值还原为数据行"""
+    row = dict(zip(DETAIL_COLUMNS, values))
+    row['日期'] = _decode_date(row['日期'], values[-1])
+    return row
+
+
+class DeliveryLedger:
+    """送货明细台账（SQLite）
+
+    以文件路径为键记录文件大小、修改时间和内容哈希，判断规则与ExtractCache相同。
+    每个新解析的文件在store()时立即提交，运行中途被取消或崩溃不会丢失已解析的文件。
+    """
+
+    def __init__(self, ledger_file):
+        self.ledger_file = Path(ledger_file)
+        self.ledger_file.parent.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        # 未命中文件的签名，解析完成后与结果一起写入台账
+        self._pending = {}
+        self.conn = sqlite3.connect(self.ledger_file)
+        self.load()
+
+    def load(self):
+        """创建表和索引；提取逻辑的版本变化时清空台账"""
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(_SCHEMA)
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != str(EXTRACT_CACHE_VERSION):
+            with self.conn:
+                self.conn.execute('DELETE FROM lines')
+                self.conn.execute('DELETE FROM files')
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+                                  (str(EXTRACT_CACHE_VERSION),))
+
+    def _rows_of(self, file_id):
+        cursor = self.conn.execute(
+            f'SELECT {_LINE_COLUMNS}, 日期类型 FROM lines WHERE file_id = ? ORDER BY line_no', (file_id,))
+        return [_row_of(values) for values in cursor]
+
+    def lookup(self, file_path, signature=None):
+        """返回台账中的数据行，文件为新增或已修改时返回None（signature同ExtractCache.lookup）"""
+        key = file_cache_key(file_path)
+        size, mtime = signature or file_signature(file_path)
+        entry = self.conn.execute('SELECT file_id, size, mtime, digest FROM files WHERE path = ?',
+                                  (key,)).fetchone()
+
+        if entry and entry[1] == size and entry[2] == mtime:
+            self.hits += 1
+            return self._rows_of(entry[0])
+
+        digest = file_digest(file_path)
+        if entry and entry[3] == digest:
+            with self.conn:
+                self.conn.execute('UPDATE files SET size = ?, mtime = ? WHERE file_id = ?',
+                                  (size, mtime, entry[0]))
+            self.hits += 1
+            return self._rows_of(entry[0])
+
+        self.misses += 1
+        self._pending[key] = (size, mtime, digest)
+        return None
+
+    def digest(self, file_path):
+        """返回lookup时得到的文件内容哈希"""
+        key = file_cache_key(file_path)
+        if key in self._pending:
+            return self._pending[key][2]
+        return self.conn.execute('SELECT digest FROM files WHERE path = ?', (key,)).fetchone()[0]
+
+    def discard(self, file_path):
+        """不解析lookup未命中的文件（如跳过的重复文件）：清除其待写入的签名，不计为未命中"""
+        if self._pending.pop(file_cache_key(file_path), None) is not None:
+            self.misses -= 1
+
+    def store(self, file_path, rows):
+        """写入（或替换）新解析文件的数据行，必须先对该文件调用过lookup"""
+        key = file_cache_key(file_path)
+        size, mtime, digest = self._pending.pop(key)
+        # 同一文件的客户和日期相同，月份只需计算一次
+        month = month_of_date(rows[0]['日期']) if rows else None
+        with self.conn:
+            self.conn.execute('DELETE FROM lines WHERE file_id = (SELECT file_id FROM files WHERE path = ?)',
+                              (key,))
+            self.conn.execute(
+                'INSERT INTO files (path, size, mtime, digest) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, '
+                'digest = excluded.digest', (key, size, mtime, digest))
+            file_id = self.conn.execute('SELECT file_id FROM files WHERE path = ?', (key,)).fetchone()[0]
+            self.conn.executemany(_INSERT_LINE, [
+                (file_id, line_no, *_line_values(row), month) for line_no, row in enumerate(rows)
+            ])
+
+    def prune(self, excel_files):
+        """删除不在excel_files中的文件（已删除的，或被跳过的重复文件）及其明细"""
+        keep = {file_cache_key(file_path) for file_path in excel_files}
+        stale = [(file_id,) for file_id, path in self.conn.execute('SELECT file_id, path FROM files')
+                 if path not in keep]
+        with self.conn:
+            self.conn.executemany('DELETE FROM lines WHERE file_id = ?', stale)
+            self.conn.executemany('DELETE FROM files WHERE file_id = ?', stale)
+
+    def fingerprint(self, excel_files):
+        """返回excel_files内容的指纹（与ExtractCache.fingerprint相同），有文件未经lookup时返回None"""
+        digests = dict(self.conn.execute('SELECT path, digest FROM files'))
+        digests.update({key: pending[2] for key, pending in self._pending.items()})
+        return files_fingerprint(excel_files, digests)
+
+    def save(self):
+        """每个文件在store()时已提交，这里只合并WAL日志"""
+        self.conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def rows(self, customer=None, month=None):
+        """查询数据行（按来源文件和行号排列），可按客户和月份（YYYY-MM）筛选"""
+        conditions, params = [], []
+        if customer is not None:
+            conditions.append('l.客户 = ?')
+            params.append(customer)
+        if month is not None:
+            conditions.append('l.月份 = ?')
+            params.append(month)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        cursor = self.conn.execute(
+            f"SELECT {', '.join('l.' + column for column in DETAIL_COLUMNS)}, l.日期类型 "
+            f'FROM lines l JOIN files f ON f.file_id = l.file_id {where} ORDER BY f.path, l.line_no', params)
+        return [_row_of(values) for values in cursor]
+
+    def detail_frame(self, customer=None, month=None):
+        """查询结果转换为与build_detail_frame相同的详细数据表，可直接用于透视分析和对账单"""
+        return build_detail_frame(self.rows(customer=customer, month=month))
+
+    def close(self):
+        self.conn.close()
+
+
+def generate_statement_from_ledger(ledger, customer, year_month, output_dir='output', progress=None,
+                                   **statement_options):
+    """从台账生成一个客户月份（YYYY-MM）的对账单，返回(对账单路径, 明细行数)；没有明细时返回None
+
+    台账的内容为最近一次合并时的送货单。对账单保存到与generate_statements相同的位置，
+    并记入对账单清单，之后批量生成时输入未变化的这个对账单会被跳过。
+    statement_options为对账单的抬头参数（同generate_statements）。
+    """
+    year_month = pd.Period(year_month, freq='M')
+    df_all = ledger.detail_frame(customer=customer, month=str(year_month))
+    # 与合并后的详细数据相同的顺序
+    df_all = prepare_statement_data(df_all.sort_values(['货名', '规格', '日期']))
+    if df_all.empty:
+        return None
+
+    output_file = statement_output_file(output_dir, customer, year_month)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    group_data = df_all[STATEMENT_COLUMNS]
+    create_statement(group_data, customer, statement_title_month(year_month), str(output_file),
+                     progress=progress, **statement_header_options(statement_options))
+
+    manifest = StatementManifest(Path(output_dir) / '.statement_manifest.json')
+    manifest.record(output_file.relative_to(output_dir).as_posix(),
+                    statement_fingerprint(group_data, customer, str(year_month), statement_options))
+    manifest.save()
+    return output_file, len(group_data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='从送货明细台账生成一个客户月份的对账单')
+    parser.add_argument('customer', help='客户名称')
+    parser.add_argument('year_month', help='年月，如2023-01')
+    parser.add_argument('--ledger', default='output/delivery_ledger.sqlite',
+                        help='台账文件（默认: output/delivery_ledger.sqlite）')
+    parser.add_argument('--output', default='output', help='输出文件夹（默认: output）')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.ledger):
+        print(f"台账不存在: {args.ledger}，请先运行 merge_delivery_orders.py --ledger {args.ledger}")
+        sys.exit(1)
+
+    loaded = time.perf_counter()
+    ledger = DeliveryLedger(args.ledger)
+    try:
+        result = generate_statement_from_ledger(ledger, args.customer, args.year_month, output_dir=args.output)
+    finally:
+        ledger.close()
+    if result is None:
+        print(f"台账中没有 {args.customer} {args.year_month} 的送货记录")
+        sys.exit(1)
+    output_file, rows = result
+    print(f"\n对账单已生成: {output_file}（{rows} 行明细，用时 {time.perf_counter() - _STARTED:.2f} 秒，"
+          f"其中加载程序 {loaded - _STARTED:.2f} 秒）")
@@ -0,0 +1,164 @@
+"""
+生成模拟送货单，用于性能测试
+
+生成的文件与extract_data_from_excel()读取的模板一致：第6行为客户名称和日期，
+第9行为表头，第10行起为送货明细，最后是合计行。
+"""
+import argparse
+import datetime
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from openpyxl import Workbook
+
+try:
+    import xlwt
+except ImportError:  # 没有安装开发依赖xlwt时只能生成.xlsx
+    xlwt = None
+
+PRODUCT_NAMES = ['PP料', 'ABS颗粒', 'PVC管', '尼龙扎带', 'PE膜', '硅胶垫', '不锈钢螺丝', '铜接头',
+                 '纸箱', '胶带', '气泡袋', '封箱钉', '塑料托盘', '编织袋', '防静电袋', '珍珠棉']
+SPECS = ['', '5*5', '10kg', '25kg/包', 'M4*12', 'M6*20', '50*60cm', '1.2mm', '大号', '小号']
+UNITS = ['包', 'kg', '个', '卷', '箱', '米', '']
+SALESPEOPLE = ['张三', '李四', '王五', '赵六']
+HEADERS = {1: '货名', 3: '规格', 5: '数量', 6: '单位', 7: '单价', 8: '金额'}
+
+
+def build_catalog(rng, products):
+    """生成产品目录：(货名, 规格, 单位, 单价)"""
+    catalog = []
+    for i in range(products):
+        name = f'{rng.choice(PRODUCT_NAMES)}{i // len(PRODUCT_NAMES) or ""}'
+        # 少数货名带换行，提取时会被清理
+        if rng.random() < 0.05:
+            name = name[:2] + '\n' + name[2:]
+        catalog.append((name, rng.choice(SPECS), rng.choice(UNITS), round(rng.uniform(0.5, 200), 2)))
+    return catalog
+
+
+def build_note_cells(rng, catalog, customer, date):
+    """生成一张送货单的单元格：{(行, 列): 值}"""
+    cells = {
+        (0, 1): '百惠行送货单',
+        (1, 1): '地址：东莞市黄江镇华南塑胶城区132号',
+        (2, 1): '电话：(0769) 83631717    传真：83637787',
+        (6, 1): '客户：',
+        (6, 2): customer,
+        (6, 7): '日期：',
+        (6, 8): date,
+    }
+    cells.update({(9, col): header for col, header in HEADERS.items()})
+
+    row = 10
+    total = 0
+    for _ in range(rng.randint(1, 15)):
+        name, spec, unit, price = rng.choice(catalog)
+        quantity = rng.choice([rng.randint(1, 200), round(rng.uniform(0.5, 50), 1)])
+        amount = round(quantity * price, 2)
+        total += amount
+        cells[(row, 1)] = name
+        if spec:
+            cells[(row, 3)] = spec
+        cells[(row, 5)] = quantity
+        if unit:
+            cells[(row, 6)] = unit
+        cells[(row, 7)] = price
+        cells[(row, 8)] = amount
+        row += 1
+        # 偶尔夹杂空行
+        if rng.random() < 0.03:
+            row += 1
+
+    cells[(row, 1)] = '合计金额'
+    cells[(row, 8)] = round(total, 2)
+    cells[(row + 2, 1)] = '收货人签名：'
+    return cells
+
+
+def write_xlsx(path, cells):
+    wb = Workbook()
+    ws = wb.active
+    for (row, col), value in cells.items():
+        cell = ws.cell(row=row + 1, column=col + 1, value=value)
+        if isinstance(value, datetime.datetime):
+            cell.number_format = 'yyyy-mm-dd'
+    wb.save(path)
+
+
+def write_xls(path, cells):
+    wb = xlwt.Workbook(encoding='utf-8')
+    ws = wb.add_sheet('送货单')
+    date_style = xlwt.easyxf(num_format_str='YYYY-MM-DD')
+    for (row, col), value in cells.items():
+        if isinstance(value, datetime.datetime):
+            ws.write(row, col, value, date_style)
+        else:
+            ws.write(row, col, value)
+    wb.save(str(path))
+
+
+def _generate_batch(task):
+    """生成一批送货单，返回生成的文件数"""
+    output_dir, indexes, seed, customers, products, months, xls_ratio = task
+    catalog = build_catalog(random.Random(0), products)
+    start = datetime.datetime(2023, 1, 1)
+    for index in indexes:
+        note_rng = random.Random(seed * 1_000_003 + index)
+        customer = f'客户{note_rng.randrange(customers):04d}'
+        month = note_rng.randrange(months)
+        date = datetime.datetime(start.year + month // 12, month % 12 + 1, note_rng.randint(1, 28))
+        cells = build_note_cells(note_rng, catalog, customer, date)
+
+        folder = Path(output_dir) / note_rng.choice(SALESPEOPLE) / date.strftime('%Y-%m')
+        folder.mkdir(parents=True, exist_ok=True)
+        if xlwt is not None and note_rng.random() < xls_ratio:
+            write_xls(folder / f'送货单{index:06d}.xls', cells)
+        else:
+            write_xlsx(folder / f'送货单{index:06d}.xlsx', cells)
+    return len(indexes)
+
+
+def generate_sample_data(output_dir, notes=1000, customers=200, products=300, months=12,
+                         xls_ratio=0.5, seed=0, workers=1):
+    """在output_dir下生成notes张模拟送货单（按业务员/月份分子目录）
+
+    同样的参数总是生成相同的文件。没有安装xlwt时全部生成.xlsx。
+    """
+    if xlwt is None and xls_ratio > 0:
+        print("未安装xlwt（开发依赖，可用 uv sync 安装），只生成.xlsx文件")
+
+    batch_size = 200
+    tasks = [
+        (str(output_dir), range(start, min(start + batch_size, notes)), seed,
+         customers, products, months, xls_ratio)
+        for start in range(0, notes, batch_size)
+    ]
+    generated = 0
+    if workers <= 1:
+        for task in tasks:
+            generated += _generate_batch(task)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for count in executor.map(_generate_batch, tasks):
+                generated += count
+    print(f"已生成 {generated} 张送货单: {output_dir}")
+    return generated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='生成模拟送货单，用于性能测试')
+    parser.add_argument('output_dir', help='输出文件夹')
+    parser.add_argument('--notes', type=int, default=1000, help='送货单数量（默认: 1000）')
+    parser.add_argument('--customers', type=int, default=200, help='客户数量（默认: 200）')
+    parser.add_argument('--products', type=int, default=300, help='产品数量（默认: 300）')
+    parser.add_argument('--months', type=int, default=12, help='跨越的月份数（默认: 12）')
+    parser.add_argument('--xls-ratio', type=float, default=0.5, help='.xls文件的比例（默认: 0.5）')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子（默认: 0）')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='并行生成的进程数（默认: CPU核心数）')
+    args = parser.parse_args()
+
+    generate_sample_data(args.output_dir, notes=args.notes, customers=args.customers,
+                         products=args.products, months=args.months, xls_ratio=args.xls_ratio,
+                         seed=args.seed, workers=args.workers)
@@ -4,13 +4,44 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, scrolledtext, messagebox
 import threading
+import queue
+import multiprocessing
 from pathlib import Path
 import sys
 import os
+import traceback
 
 # 导入核心功能
-from merge_delivery_orders import merge_delivery_orders, create_statement
-import pandas as pd
+from merge_delivery_orders import (
+    merge_delivery_orders, generate_statements, prepare_statement_data, RunReport,
+    GenerationCancelled,
+)
+
+
+class GenerationJob:
+    """一次生成任务：在后台线程中运行target(job, *args)，可随时取消
+
+    提取结果和已生成的对账单随时写入检查点，取消或崩溃后再次运行会从中断处继续。
+    """
+
+    def __init__(self, target, *args):
+        self.cancel_event = threading.Event()
+        self._thread = threading.Thread(target=target, args=(self, *args))
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def cancel(self):
+        """请求取消，任务在当前文件或对账单完成后停止"""
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def is_running(self):
+        return self._thread.is_alive()
 
 
 class DeliveryOrderApp:
@@ -45,8 +76,14 @@ class DeliveryOrderApp:
         # 设置默认路径
         self.raw_data_path = tk.StringVar(value="raw-data")
         self.output_path = tk.StringVar(value="output")
+        self.save_report = tk.BooleanVar(value=False)
+        self.job = None
+
+        # 后台线程不直接操作控件，日志和状态更新放入队列，由主线程定时处理
+        self.ui_queue = queue.Queue()
 
         self.setup_ui()
+        self.root.after(self.UI_POLL_MS, self._drain_ui_queue)
 
     def setup_styles(self):
         """配置现代化的ttk样式"""
@@ -147,6 +184,10 @@ class DeliveryOrderApp:
         ttk.Button(path_frame2, text="📂 浏览", command=self.browse_output,
                   style='Secondary.TButton').pack(side=tk.LEFT)
 
+        # 运行报告开关
+        ttk.Checkbutton(config_frame, text="保存运行报告（各阶段和每个文件的耗时，run_report.json）",
+                        variable=self.save_report).grid(row=4, column=0, sticky=tk.W, pady=(10, 0))
+
         config_frame.columnconfigure(0, weight=1)
 
         # 操作按钮区域
@@ -161,6 +202,11 @@ class DeliveryOrderApp:
                                      style='Primary.TButton')
         self.run_button.pack(side=tk.LEFT, padx=5)
 
+        self.cancel_button = ttk.Button(button_container, text="⏹ 取消",
+                                        command=self.cancel_generation,
+                                        style='Secondary.TButton', state='disabled')
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
+
         ttk.Button(button_container, text="📁 打开输出文件夹",
                   command=self.open_output_folder,
                   style='Secondary.TButton').pack(side=tk.LEFT, padx=5)
@@ -220,8 +266,16 @@ class DeliveryOrderApp:
         else:
             messagebox.showwarning("警告", "输出文件夹不存在")
 
+    # 界面更新队列的轮询间隔（毫秒）、每次最多处理的消息数和日志最多保留的行数
+    UI_POLL_MS = 100
+    UI_BATCH_SIZE = 2000
+    MAX_LOG_LINES = 5000
+
     def log(self, message, level='info'):
-        """添加日志消息，支持不同级别的颜色"""
+        """添加日志消息，支持不同级别的颜色
+
+        可在任意线程调用：消息先放入队列，由主线程定时批量写入日志框。
+        """
         # 根据级别添加emoji前缀
         prefixes = {
             'info': 'ℹ️',
@@ -233,37 +287,140 @@ class DeliveryOrderApp:
         prefix = prefixes.get(level, '')
         formatted_message = f"{prefix} {message}" if prefix else message
 
-        self.log_text.insert(tk.END, formatted_message + "\n")
+        self.ui_queue.put(('log', formatted_message))
+
+    def call_in_ui(self, func, *args, **kwargs):
+        """在主线程中执行func，用于在后台线程中操作界面控件"""
+        self.ui_queue.put(('call', func, args, kwargs))
+
+    def _drain_ui_queue(self):
+        """主线程定时处理界面更新队列：日志合并为一次插入，进度只显示最新的状态"""
+        lines = []
+        progress_state = None
+        try:
+            try:
+                for _ in range(self.UI_BATCH_SIZE):
+                    item = self.ui_queue.get_nowait()
+                    if item[0] == 'log':
+                        lines.append(item[1])
+                    elif item[0] == 'progress':
+                        progress_state = item[1:]
+                    else:
+                        # 先显示之前的日志和进度，保持与调用顺序一致
+                        self._run_ui_call(self._append_log, lines)
+                        lines = []
+                        if progress_state:
+                            self._run_ui_call(self._show_progress, *progress_state)
+                            progress_state = None
+                        _, func, args, kwargs = item
+                        self._run_ui_call(func, *args, **kwargs)
+            except queue.Empty:
+                pass
+
+            self._run_ui_call(self._append_log, lines)
+            if progress_state:
+                self._run_ui_call(self._show_progress, *progress_state)
+        finally:
+            # 总是继续定时处理队列，否则之后的日志、进度和运行结束的处理（_finish_run）都不会执行
+            self.root.after(self.UI_POLL_MS, self._drain_ui_queue)
+
+    def _run_ui_call(self, func, *args, **kwargs):
+        """执行一项界面更新；出错时记录错误后继续，不影响队列中之后的更新"""
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            message = f"界面更新出错:\n{traceback.format_exc()}"
+            # 打包为窗口程序时sys.stderr为None，print不输出
+            print(message, file=sys.stderr)
+            try:
+                self.log_text.insert(tk.END, message + '\n')
+            except Exception:
+                pass
+
+    def _append_log(self, lines):
+        """一次写入多行日志，超出MAX_LOG_LINES时删除最早的行"""
+        if not lines:
+            return
+        self.log_text.insert(tk.END, '\n'.join(lines) + '\n')
+        line_count = int(self.log_text.index('end-1c').split('.')[0]) - 1
+        if line_count > self.MAX_LOG_LINES:
+            self.log_text.delete('1.0', f'{line_count - self.MAX_LOG_LINES + 1}.0')
         self.log_text.see(tk.END)
-        self.root.update()
+
+    def _show_progress(self, stage_name, done, total):
+        self.progress.stop()
+        self.progress.config(mode='determinate', maximum=total, value=done)
+        self.status_label.config(text=f"{stage_name}: {done}/{total}")
 
     def update_status(self, message, progress=False):
-        """更新状态标签"""
+        """更新状态标签（可在任意线程调用）"""
+        self.call_in_ui(self._apply_status, message, progress)
+
+    def _apply_status(self, message, progress):
         self.status_label.config(text=message)
         if progress:
             if not self.progress['value']:
+                self.progress.config(mode='indeterminate')
                 self.progress.start(10)
         else:
             self.progress.stop()
             self.progress['value'] = 0
 
-    def run_generation(self):
-        # 在新线程中运行，避免界面冻结
-        thread = threading.Thread(target=self._run_generation_thread)
-        thread.daemon = True
-        thread.start()
+    # 进度条显示的阶段名称
+    STAGE_NAMES = {
+        'discovery': '查找文件',
+        'extract': '提取数据',
+        'aggregate': '合并汇总',
+        'pivot': '生成透视分析',
+        'write': '保存合并文件',
+        'summary': '合并完成',
+        'statements': '生成对账单',
+    }
+
+    def on_progress(self, event):
+        """核心函数的进度回调（在后台线程中调用）：日志和进度放入界面更新队列"""
+        if event['message'] is not None:
+            level = 'error' if event['level'] == 'error' else 'info'
+            for line in event['message'].split('\n'):
+                if line.strip():
+                    self.log(line, level)
+        if event['total']:
+            stage_name = self.STAGE_NAMES.get(event['stage'], event['stage'])
+            self.ui_queue.put(('progress', stage_name, event['done'], event['total']))
 
-    def _run_generation_thread(self):
-        try:
-            # 禁用运行按钮
-            self.run_button.config(state='disabled')
-            self.progress.start()
+    def run_generation(self):
+        # 界面变量在主线程中读取后传给后台线程
+        raw_data_dir = self.raw_data_path.get()
+        output_dir = self.output_path.get()
+        save_report = self.save_report.get()
 
-            # 清空日志
-            self.log_text.delete(1.0, tk.END)
+        # 禁用运行按钮，清空日志
+        self.run_button.config(state='disabled')
+        self.cancel_button.config(state='normal')
+        self.progress.config(mode='indeterminate')
+        self.progress.start()
+        self.log_text.delete(1.0, tk.END)
 
-            raw_data_dir = self.raw_data_path.get()
-            output_dir = self.output_path.get()
+        # 在新线程中运行，避免界面冻结
+        self.job = GenerationJob(self._run_generation_thread, raw_data_dir, output_dir, save_report)
+        self.job.start()
+
+    def cancel_generation(self):
+        if self.job is not None and self.job.is_running():
+            self.job.cancel()
+            self.cancel_button.config(state='disabled')
+            self.log("正在取消，当前文件或对账单完成后停止...", 'warning')
+            self.update_status("正在取消...", progress=True)
+
+    def _finish_run(self):
+        """恢复按钮和进度条"""
+        self.progress.stop()
+        self.run_button.config(state='normal')
+        self.cancel_button.config(state='disabled')
+
+    def _run_generation_thread(self, job, raw_data_dir, output_dir, save_report):
+        try:
+            report = RunReport()
 
             self.log("=" * 60)
             self.log("送货单对账单生成工具 v1.0", 'info')
@@ -276,7 +433,7 @@ class DeliveryOrderApp:
             if not os.path.exists(raw_data_dir):
                 self.log(f"原始数据文件夹不存在: {raw_data_dir}", 'error')
                 self.update_status("错误：文件夹不存在", progress=False)
-                messagebox.showerror("错误", "原始数据文件夹不存在")
+                self.call_in_ui(messagebox.showerror, "错误", "原始数据文件夹不存在")
                 return
 
             # 创建输出目录
@@ -285,76 +442,38 @@ class DeliveryOrderApp:
             # 合并送货单
             output_file = os.path.join(output_dir, 'merged_delivery_orders.xlsx')
 
-            # 重定向print输出到日志
-            import io
-            from contextlib import redirect_stdout
-
-            log_stream = io.StringIO()
-            with redirect_stdout(log_stream):
-                df_summary = merge_delivery_orders(
-                    raw_data_dir=raw_data_dir,
-                    output_file=output_file
-                )
-
-            # 显示合并过程的日志
-            for line in log_stream.getvalue().split('\n'):
-                if line.strip():
-                    self.log(line)
-
-            # 读取详细数据用于生成对账单
-            df_all = pd.read_excel(output_file, sheet_name='详细数据')
-
-            # 转换日期列为datetime类型
-            df_all['日期'] = pd.to_datetime(df_all['日期'])
-
-            # 提取年月
-            df_all['年月'] = df_all['日期'].dt.to_period('M')
+            # 合并过程的日志和进度通过回调实时显示
+            df_summary, df_all = merge_delivery_orders(
+                raw_data_dir=raw_data_dir,
+                output_file=output_file,
+                workers=os.cpu_count(),
+                return_detail=True,
+                report=report,
+                progress=self.on_progress,
+                cancel=job.cancel_event
+            )
+
+            if df_all is None:
+                self.log("没有可用于生成对账单的数据", 'error')
+                self.update_status("错误：没有数据", progress=False)
+                self.call_in_ui(messagebox.showerror, "错误", "原始数据文件夹中没有找到送货单数据")
+                return
 
-            # 按客户和年月分组
-            grouped = df_all.groupby(['客户', '年月'])
+            # 转换日期列并提取年月
+            df_all = prepare_statement_data(df_all)
 
             self.update_status("生成对账单中...", progress=True)
             self.log(f"开始生成对账单...", 'processing')
-            self.log(f"共有 {len(grouped)} 个客户月份组合\n")
 
-            # 创建输出目录
-            output_path = Path(output_dir)
-            output_path.mkdir(exist_ok=True)
-
-            # 为每个客户的每个月生成对账单
-            skipped_count = 0
-            generated_count = 0
-
-            for (customer, year_month), group_data in grouped:
-                # 创建客户文件夹
-                customer_dir = output_path / customer
-                customer_dir.mkdir(exist_ok=True)
-
-                # 生成文件名
-                statement_file = customer_dir / f'statement_{customer}_{year_month}.xlsx'
-
-                # 检查文件是否已存在
-                if statement_file.exists():
-                    self.log(f"已存在，跳过: {customer} {year_month}", 'warning')
-                    skipped_count += 1
-                    continue
-
-                # 格式化年月显示
-                year_month_str = f'{year_month.year}年{year_month.month}月'
-
-                self.log(f"生成: {customer} {year_month_str}", 'processing')
-
-                # 生成对账单
-                log_stream = io.StringIO()
-                with redirect_stdout(log_stream):
-                    create_statement(
-                        group_data,
-                        customer_name=customer,
-                        year_month=year_month_str,
-                        output_file=str(statement_file)
-                    )
-
-                generated_count += 1
+            # 为每个客户的每个月生成对账单（多进程并行）
+            generated_count, skipped_count = generate_statements(
+                df_all,
+                output_dir=output_dir,
+                workers=os.cpu_count(),
+                report=report,
+                progress=self.on_progress,
+                cancel=job.cancel_event
+            )
 
             self.log("")
             self.log("=" * 60)
@@ -362,30 +481,39 @@ class DeliveryOrderApp:
             self.log(f"✅ 新生成: {generated_count} 个对账单")
             self.log(f"⏭️  已跳过: {skipped_count} 个对账单")
             self.log(f"📁 保存位置: {output_dir}")
+            if save_report:
+                report_file = os.path.join(output_dir, 'run_report.json')
+                report.save(report_file)
+                self.log(f"📊 运行报告: {report_file}")
             self.log("=" * 60)
 
             self.update_status(f"✅ 完成！生成 {generated_count} 个对账单", progress=False)
-            messagebox.showinfo("完成",
-                              f"🎉 生成完成！\n\n" +
-                              f"✅ 新生成: {generated_count} 个对账单\n" +
-                              f"⏭️  已跳过: {skipped_count} 个对账单\n\n" +
-                              f"文件保存在: {output_dir}")
+            self.call_in_ui(messagebox.showinfo, "完成",
+                            f"🎉 生成完成！\n\n" +
+                            f"✅ 新生成: {generated_count} 个对账单\n" +
+                            f"⏭️  已跳过: {skipped_count} 个对账单\n\n" +
+                            f"文件保存在: {output_dir}")
+
+        except GenerationCancelled:
+            self.log("")
+            self.log("已取消。已提取的文件和已生成的对账单已保存，再次运行时从中断处继续", 'warning')
+            self.update_status("⏹ 已取消", progress=False)
 
         except Exception as e:
             self.log("")
             self.log(f"处理过程中出错: {str(e)}", 'error')
-            import traceback
             self.log(traceback.format_exc())
             self.update_status("❌ 处理失败", progress=False)
-            messagebox.showerror("错误", f"❌ 处理过程中出错:\n\n{str(e)}")
+            self.call_in_ui(messagebox.showerror, "错误", f"❌ 处理过程中出错:\n\n{str(e)}")
 
         finally:
             # 恢复按钮和进度条
-            self.progress.stop()
-            self.run_button.config(state='normal')
+            self.call_in_ui(self._finish_run)
 
 
 def main():
+    # 打包后的程序使用多进程时需要
+    multiprocessing.freeze_support()
     root = tk.Tk()
     app = DeliveryOrderApp(root)
     root.mainloop()
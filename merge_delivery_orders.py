@@ -1,197 +1,1455 @@
 """
 合并所有送货单的出货品类及数量
 """
+import numpy as np
 import pandas as pd
 import os
+import io
+import csv
+import sys
+import fnmatch
+import gzip
+import hashlib
+import heapq
+import inspect
+import itertools
+import json
+import pickle
+import re
+import shutil
+import time
+import traceback
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
+from functools import lru_cache, partial
+import datetime
 from pathlib import Path
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
+import xlrd
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell.cell import ERROR_CODES, WriteOnlyCell
+from openpyxl.styles import Font, Alignment, Border, Side, PatternFill, NamedStyle
 from openpyxl.utils import get_column_letter
 from openpyxl.worksheet.page import PageMargins
 
-def extract_data_from_excel(file_path):
-    """从单个Excel文件提取数据"""
+# 提取逻辑或结果格式变化时递增，使旧的提取缓存失效
+EXTRACT_CACHE_VERSION = 3
+
+# 流式读取的列数，表头和客户、日期单元格须在这些列中
+TEMPLATE_COLUMNS = 16
+
+# 表头的列名，依次对应build_data_rows的货名、规格、数量、单位、单价、金额；
+# 单元格文本包含列名即可（如"单价(元)"）
+HEADER_LABELS = ('货名', '规格', '数量', '单位', '单价', '金额')
+
+# 默认模板：第9行为表头，第6行为客户名称（第2列）和日期（第8列），表头下一行起为送货明细
+DEFAULT_LAYOUT = {'header_row': 9, 'columns': (1, 3, 5, 6, 7, 8), 'customer': (6, 2), 'date': (6, 8)}
+
+# 在前多少行中查找表头
+LAYOUT_SEARCH_ROWS = 30
+
+# pandas读取Excel时视为空值的字符串，流式读取时按相同规则处理
+_NA_STRINGS = frozenset([
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+    '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null',
+])
+
+def extract_data_from_excel(file_path, engine='stream'):
+    """从单个Excel文件提取数据
+
+    engine为'stream'时按行流式读取，读到合计行即停止；为'pandas'时用pd.read_excel读取整张表。
+    """
     print(f"正在处理: {file_path}")
+    data_rows, error = _extract_file(file_path, engine)
+    if error is not None:
+        print(f"  处理 {file_path} 时出错: {error[0]}")
+        _write_stream(sys.stderr, error[1])
+    return data_rows
 
-    try:
-        # 读取Excel文件，不设置header
-        df = pd.read_excel(file_path, sheet_name=0, header=None)
-
-        # 提取客户名称和日期
-        customer_name = None
-        date = None
-        if len(df) > 6:
-            # 第6行包含客户名称和日期
-            row_6 = df.iloc[6]
-            if pd.notna(row_6[2]):
-                customer_name = str(row_6[2]).strip()
-            if pd.notna(row_6[8]):
-                date = row_6[8]
-
-        # 数据从第10行开始，直到遇到"合计金额"
-        data_rows = []
-        for idx in range(10, len(df)):
-            row = df.iloc[idx]
-
-            # 检查是否到达合计行
-            if pd.notna(row[1]) and '合计' in str(row[1]):
-                break
+def _extract_file(file_path, engine='stream'):
+    """从单个Excel文件提取数据，返回(数据行, 错误)
 
-            # 提取货名、规格、数量、单位、单价、金额
-            product_name = row[1] if pd.notna(row[1]) else None
-            spec = row[3] if pd.notna(row[3]) else None
-            quantity = row[5] if pd.notna(row[5]) else None
-            unit = row[6] if pd.notna(row[6]) else None
-            unit_price = row[7] if pd.notna(row[7]) else None
-            amount = row[8] if pd.notna(row[8]) else None
-
-            # 只保留有效的数据行（至少有货名和数量）
-            if product_name and quantity:
-                # 清理货名中的换行符
-                product_name = str(product_name).replace('\n', ' ').strip()
-                if spec:
-                    spec = str(spec).strip()
-                if unit:
-                    unit = str(unit).strip()
-
-                data_rows.append({
-                    '货名': product_name,
-                    '规格': spec if spec else '',
-                    '数量': float(quantity),
-                    '单位': unit if unit else '',
-                    '单价': float(unit_price) if unit_price else 0,
-                    '金额': float(amount) if amount else 0,
-                    '客户': customer_name if customer_name else '',
-                    '日期': date if date else '',
-                    '文件': os.path.basename(file_path)
-                })
-
-        return data_rows
+    出错时数据行为空，错误为(错误信息, 异常堆栈)；成功时错误为None。
+    """
+    try:
+        row_reader = _template_row_reader(file_path) if engine == 'stream' else None
+        if row_reader is None:
+            data_rows = _extract_with_pandas(file_path)
+        else:
+            data_rows = _extract_streaming(file_path, row_reader)
+        return data_rows, None
 
     except Exception as e:
-        print(f"  处理 {file_path} 时出错: {e}")
-        import traceback
-        traceback.print_exc()
+        return [], (str(e), traceback.format_exc())
+
+# 已识别的模板布局，以表头位置（表头行, 各列）为签名。
+# 每个文件先核对已知模板的表头，只有新的模板才需要查找表头和客户、日期单元格
+_known_layouts = {(DEFAULT_LAYOUT['header_row'], DEFAULT_LAYOUT['columns']): DEFAULT_LAYOUT}
+
+# 找不到表头的送货单的前几行文本（见_head_signature），同样的文件不再重复查找表头；最多记录的数量
+_headerless_heads = set()
+HEADERLESS_CACHE_SIZE = 256
+
+def _cell_label(value):
+    """单元格文本去掉所有空白，用于匹配表头和标签；非文本返回None"""
+    return ''.join(value.split()) if isinstance(value, str) else None
+
+def _layout_cell(head, position):
+    """布局中(行, 列)位置的单元格值，超出范围或没有该位置时返回None"""
+    if position is None:
+        return None
+    row, col = position
+    if row >= len(head) or col >= len(head[row]):
+        return None
+    return head[row][col]
+
+def _label_matches(label, header_label):
+    """单元格文本（_cell_label的结果）是否为该列名，允许带单位等前后缀"""
+    return label is not None and header_label in label
+
+def _find_header_columns(row):
+    """一行中各列名所在的列，没有的为None"""
+    labels = [_cell_label(value) for value in row]
+    return [next((col for col, label in enumerate(labels) if _label_matches(label, header_label)), None)
+            for header_label in HEADER_LABELS]
+
+def detect_layout(head):
+    """在送货单的前几行（值的列表的列表，空单元格为None）中查找表头，返回布局；找不到表头时返回None
+
+    表头为同时包含"货名"和"数量"的第一行。表头在默认模板的位置时使用默认模板；
+    其余列名缺失时按默认模板中与货名列的相对位置确定该列，不会因列名写法不同而丢失数据。
+    客户和日期取表头上方"客户"、"日期"标签右侧的单元格；没有标签时取表头上方第3行的
+    货名列右侧和金额列，与默认模板的相对位置相同。
+    """
+    for header_row, row in enumerate(head):
+        found = _find_header_columns(row)
+        if found[0] is not None and found[2] is not None:
+            break
+    else:
+        return None
+
+    offset = found[0] - DEFAULT_LAYOUT['columns'][0]
+    if header_row == DEFAULT_LAYOUT['header_row'] and offset == 0:
+        return DEFAULT_LAYOUT
+    columns = tuple(col if col is not None else default + offset
+                    for col, default in zip(found, DEFAULT_LAYOUT['columns']))
+    # 超出流式读取范围的列无法读取
+    columns = tuple(col if col < TEMPLATE_COLUMNS else None for col in columns)
+
+    customer = date = None
+    for row_index in range(header_row):
+        for col, value in enumerate(head[row_index]):
+            label = _cell_label(value)
+            if not label:
+                continue
+            if customer is None and label.startswith('客户'):
+                customer = (row_index, col + 1)
+            elif date is None and label.startswith('日期'):
+                date = (row_index, col + 1)
+
+    label_row = header_row - 3
+    if label_row >= 0:
+        customer = customer or (label_row, columns[0] + 1)
+        if columns[5] is not None:
+            date = date or (label_row, columns[5])
+    return {'header_row': header_row, 'columns': columns, 'customer': customer, 'date': date}
+
+def _header_matches(head, header_row, columns):
+    """head的第header_row行在各列上是否为对应的列名
+
+    货名和数量列必须有列名；检测时按相对位置补上的列在表头中可能没有列名，其余列为空也算匹配。
+    """
+    if header_row >= len(head):
+        return False
+    row = head[header_row]
+    for label, col in zip(HEADER_LABELS, columns):
+        cell = _cell_label(row[col]) if col is not None and col < len(row) else None
+        if _label_matches(cell, label):
+            continue
+        if label in ('货名', '数量') or cell:
+            return False
+    return True
+
+def _head_signature(head):
+    """默认表头行及以上各行的文本（客户和日期单元格除外），同一模板的文件相同"""
+    skip = {DEFAULT_LAYOUT['customer'], DEFAULT_LAYOUT['date']}
+    return tuple(tuple(label for col, value in enumerate(row)
+                       if (row_index, col) not in skip and (label := _cell_label(value)))
+                 for row_index, row in enumerate(head[:DEFAULT_LAYOUT['header_row'] + 1]))
+
+def find_layout(head):
+    """确定送货单的布局：表头与已识别的模板相同时直接使用，否则查找表头，找不到时使用默认模板"""
+    for (header_row, columns), layout in _known_layouts.items():
+        if _header_matches(head, header_row, columns):
+            return layout
+    signature = _head_signature(head)
+    if signature in _headerless_heads:
+        return DEFAULT_LAYOUT
+    layout = detect_layout(head)
+    if layout is None:
+        if len(_headerless_heads) < HEADERLESS_CACHE_SIZE:
+            _headerless_heads.add(signature)
+        return DEFAULT_LAYOUT
+    _known_layouts[(layout['header_row'], layout['columns'])] = layout
+    return layout
+
+def _layout_header(head, layout):
+    """按布局取出客户名称和日期"""
+    customer_name = _layout_cell(head, layout['customer'])
+    if customer_name is not None:
+        customer_name = str(customer_name).strip()
+    return customer_name, _layout_cell(head, layout['date'])
+
+def _extract_with_pandas(file_path):
+    """用pd.read_excel读取整张表后提取数据"""
+    # 读取Excel文件，不设置header
+    df = pd.read_excel(file_path, sheet_name=0, header=None)
+
+    # 按前几行确定布局，提取客户名称和日期
+    head = [[None if pd.isna(value) else value for value in row]
+            for row in df.iloc[:LAYOUT_SEARCH_ROWS].itertuples(index=False, name=None)]
+    layout = find_layout(head)
+    customer_name, date = _layout_header(head, layout)
+
+    # 数据从表头的下一行开始，直到遇到"合计金额"
+    body = df.iloc[layout['header_row'] + 1:]
+    if body.empty:
         return []
 
-def merge_delivery_orders(raw_data_dir='raw-data', output_file='output/merged_delivery_orders.xlsx'):
-    """合并所有送货单"""
+    # 用一次整列判断找到合计行
+    first_col = body[layout['columns'][0]]
+    is_total = first_col.notna() & first_col.astype(str).str.contains('合计', regex=False)
+    stop = int(is_total.to_numpy().argmax()) if is_total.any() else len(body)
+    items = body.iloc[:stop]
+
+    # 一次性取出货名、规格、数量、单位、单价、金额列，模板中没有的列为空
+    return build_data_rows(
+        *(items[col].to_numpy(dtype=object) if col is not None and col in items.columns
+          else np.full(len(items), None, dtype=object)
+          for col in layout['columns']),
+        customer_name, date, os.path.basename(file_path)
+    )
 
-    # 创建输出目录
-    output_path = Path(output_file).parent
-    output_path.mkdir(parents=True, exist_ok=True)
+def _extract_streaming(file_path, row_reader):
+    """逐行读取模板需要的单元格，读到合计行即停止，不构建DataFrame"""
+    columns = ([], [], [], [], [], [])
 
-    # 查找所有Excel文件
-    raw_data_path = Path(raw_data_dir)
-    excel_files = list(raw_data_path.glob('**/*.xls')) + list(raw_data_path.glob('**/*.xlsx'))
+    rows = row_reader(file_path)
+    try:
+        # 按前几行确定布局，提取客户名称和日期
+        head = list(itertools.islice(rows, LAYOUT_SEARCH_ROWS))
+        layout = find_layout(head)
+        customer_name, date = _layout_header(head, layout)
+
+        # 数据从表头的下一行开始，直到遇到"合计金额"
+        name_col = layout['columns'][0]
+        for row in itertools.chain(head[layout['header_row'] + 1:], rows):
+            if row[name_col] is not None and '合计' in str(row[name_col]):
+                break
+            for values, col in zip(columns, layout['columns']):
+                values.append(row[col] if col is not None else None)
+    finally:
+        rows.close()
 
-    print(f"找到 {len(excel_files)} 个Excel文件")
-    print()
+    if not columns[0]:
+        return []
+    arrays = []
+    for values in columns:
+        array = np.empty(len(values), dtype=object)
+        array[:] = values
+        arrays.append(array)
+    return build_data_rows(*arrays, customer_name, date, os.path.basename(file_path))
+
+def _template_row_reader(file_path):
+    """按文件内容选择流式读取函数，无法识别格式时返回None（交给pandas处理）"""
+    with open(file_path, 'rb') as f:
+        head = f.read(8)
+    if head.startswith(b'PK\x03\x04'):
+        return _iter_xlsx_rows
+    if head == b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1':
+        return _iter_xls_rows
+    return None
+
+def _iter_xlsx_rows(file_path):
+    """以只读模式逐行读取.xlsx第一个工作表的前TEMPLATE_COLUMNS列"""
+    wb = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        for row in ws.iter_rows(max_col=TEMPLATE_COLUMNS, values_only=True):
+            values = [_convert_xlsx_cell(value) for value in row]
+            values.extend([None] * (TEMPLATE_COLUMNS - len(values)))
+            yield values
+    finally:
+        wb.close()
+
+def _convert_xlsx_cell(value):
+    """按pandas的规则转换单元格的值，空值返回None"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return None if value in _NA_STRINGS or value in ERROR_CODES else value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def _iter_xls_rows(file_path):
+    """按需加载.xls，只逐行读取第一个工作表的前TEMPLATE_COLUMNS列"""
+    book = xlrd.open_workbook(file_path, on_demand=True)
+    try:
+        sheet = book.sheet_by_index(0)
+        for rowx in range(sheet.nrows):
+            types = sheet.row_types(rowx, 0, TEMPLATE_COLUMNS)
+            cells = sheet.row_values(rowx, 0, TEMPLATE_COLUMNS)
+            values = [_convert_xls_cell(cell_type, value, book.datemode)
+                      for cell_type, value in zip(types, cells)]
+            values.extend([None] * (TEMPLATE_COLUMNS - len(values)))
+            yield values
+    finally:
+        book.release_resources()
+
+def _convert_xls_cell(cell_type, value, datemode):
+    """按pandas的规则转换xlrd单元格的值，空值返回None"""
+    if cell_type in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK, xlrd.XL_CELL_ERROR):
+        return None
+    if cell_type == xlrd.XL_CELL_TEXT:
+        return None if value in _NA_STRINGS else value
+    if cell_type == xlrd.XL_CELL_DATE:
+        try:
+            date_value = xlrd.xldate.xldate_as_datetime(value, datemode)
+        except OverflowError:
+            return value
+        # 只有时间部分的单元格
+        if date_value.timetuple()[0:3] in ((1899, 12, 31), (1904, 1, 1)):
+            return date_value.time()
+        return date_value
+    if cell_type == xlrd.XL_CELL_BOOLEAN:
+        return bool(value)
+    if cell_type == xlrd.XL_CELL_NUMBER and value.is_integer():
+        return int(value)
+    return value
+
+def _truthy(values):
+    """整列判断单元格是否为有效值（非空且为真）"""
+    return pd.notna(values) & values.astype(bool)
+
+def _clean_text(values):
+    """整列转换为去除首尾空白的字符串"""
+    return pd.Series(values, dtype=object).astype(str).str.strip().to_numpy(dtype=object)
+
+def _to_float_or_zero(values, present):
+    """有效值转换为浮点数，其余为0"""
+    result = np.zeros(len(values), dtype=object)
+    result[present] = values[present].astype(float)
+    return result
+
+def build_data_rows(products, specs, quantities, units, unit_prices, amounts,
+                    customer_name, date, file_name):
+    """按列清洗送货明细，返回数据行列表
+
+    各参数为同一批明细行的object数组，只保留有货名和数量的行。
+    """
+    keep = _truthy(products) & _truthy(quantities)
+    if not keep.any():
+        return []
+
+    products = products[keep]
+    specs = specs[keep]
+    units = units[keep]
+    unit_prices = unit_prices[keep]
+    amounts = amounts[keep]
+
+    # 清理货名中的换行符
+    products = pd.Series(products, dtype=object).astype(str).str.replace('\n', ' ').str.strip()
+    specs = np.where(_truthy(specs), _clean_text(specs), '')
+    units = np.where(_truthy(units), _clean_text(units), '')
+    quantities = quantities[keep].astype(float)
+    unit_prices = _to_float_or_zero(unit_prices, _truthy(unit_prices))
+    amounts = _to_float_or_zero(amounts, _truthy(amounts))
+
+    customer_name = customer_name if customer_name else ''
+    date = date if date else ''
+    return [
+        {
+            '货名': product_name,
+            '规格': spec if spec else '',
+            '数量': quantity,
+            '单位': unit if unit else '',
+            '单价': unit_price,
+            '金额': amount,
+            '客户': customer_name,
+            '日期': date,
+            '文件': file_name
+        }
+        for product_name, spec, quantity, unit, unit_price, amount in zip(
+            products.tolist(), specs.tolist(), quantities.tolist(),
+            units.tolist(), unit_prices.tolist(), amounts.tolist())
+    ]
+
+class GenerationCancelled(Exception):
+    """生成任务被取消"""
+
+def check_cancelled(cancel):
+    """cancel为threading.Event等带is_set()的对象，已设置时抛出GenerationCancelled"""
+    if cancel is not None and cancel.is_set():
+        raise GenerationCancelled()
+
+def print_progress(event):
+    """默认的进度回调：打印事件中的日志消息，与命令行原有的输出一致
+
+    进度事件是一个字典：
+      stage   阶段（discovery、extract、aggregate、pivot、write、summary、statements）
+      message 日志消息，没有消息时为None
+      level   'info'或'error'
+      done    本阶段已完成的数量，total为总数量（未知时为None）
+      item    单项结果，如{'file': ..., 'rows': ..., 'ok': ...}，没有时为None
+    """
+    if event['message'] is not None:
+        print(event['message'])
+    if event['item'] and event['item'].get('traceback'):
+        _write_stream(sys.stderr, event['item']['traceback'])
+
+def quiet_progress(event):
+    """只显示错误的进度回调（如后台运行或本机的多个分片同时运行时）"""
+    if event['level'] == 'error':
+        print_progress(event)
+
+def _write_stream(stream, text):
+    """写入标准输出或标准错误；打包为窗口程序（pyinstaller --windowed）时这些流为None，不写入"""
+    if stream is not None and text:
+        stream.write(text)
+
+def notify(progress, stage, message=None, done=None, total=None, level='info', **item):
+    """向进度回调发送一个事件"""
+    progress({'stage': stage, 'message': message, 'level': level,
+              'done': done, 'total': total, 'item': item or None})
+
+class RunReport:
+    """运行报告：记录各阶段、每个文件的提取和每张对账单的耗时及行数
+
+    各函数的report参数接收同一个RunReport，运行结束后用save()保存为JSON，
+    其中包含最慢的top_n个文件和对账单。
+    """
+
+    def __init__(self, top_n=20):
+        self.top_n = top_n
+        self.started_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self._start = time.perf_counter()
+        self.stages = []
+        self.files = []
+        self.duplicates = []
+        self.statements = []
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """记录with块的耗时；行数在进入时未知的，可在块内设置entry['rows']"""
+        entry = {'stage': name, 'start': round(time.perf_counter() - self._start, 6),
+                 'seconds': None, 'rows': rows}
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] = round(time.perf_counter() - start, 6)
+            self.stages.append(entry)
+
+    def add_file(self, file_path, seconds, rows, ok=True, cached=False):
+        self.files.append({'file': str(file_path), 'seconds': round(seconds, 6), 'rows': rows,
+                           'ok': ok, 'cached': cached})
+
+    def add_duplicate(self, file_path, original):
+        self.duplicates.append({'file': str(file_path), 'original': str(original)})
+
+    def add_statement(self, output_file, seconds, rows):
+        self.statements.append({'file': str(output_file), 'seconds': round(seconds, 6), 'rows': rows})
+
+    def _summary(self, entries):
+        return {
+            'count': len(entries),
+            'seconds': round(sum(entry['seconds'] for entry in entries), 6),
+            'rows': sum(entry['rows'] for entry in entries),
+            'slowest': sorted(entries, key=lambda entry: entry['seconds'], reverse=True)[:self.top_n],
+        }
+
+    def to_dict(self):
+        return {
+            'started_at': self.started_at,
+            'total_seconds': round(time.perf_counter() - self._start, 6),
+            # 按开始时间排列，嵌套的阶段排在外层阶段之后
+            'stages': sorted(self.stages, key=lambda entry: entry['start']),
+            # 缓存命中的文件没有提取耗时，不参与排名
+            'files': self._summary([entry for entry in self.files if not entry['cached']]),
+            'cached_files': sum(entry['cached'] for entry in self.files),
+            # 内容与其他文件相同、未计入汇总的送货单
+            'duplicates': self.duplicates,
+            'statements': self._summary(self.statements),
+        }
+
+    def save(self, report_file):
+        report_path = Path(report_file)
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+# 送货单的文件名模式
+EXCEL_PATTERNS = ('*.xls', '*.xlsx')
+
+# 查找送货单时总是跳过的文件和目录：Office/WPS的锁文件（~$*），LibreOffice锁文件（.~lock*）、
+# macOS资源文件（._*）等隐藏文件，以及临时文件和备份文件
+IGNORED_PATTERNS = ('~$*', '.*', '*.tmp', '*.bak', '*.bak.*')
+
+def _compile_patterns(patterns):
+    """模式编译为(匹配名称的正则, 匹配相对路径的正则)：含/的模式匹配相对路径，其余匹配文件名或目录名"""
+    def compile_group(group):
+        if not group:
+            return None
+        return re.compile('|'.join(fnmatch.translate(os.path.normcase(pattern)) for pattern in group))
+
+    return (compile_group([pattern for pattern in patterns if '/' not in pattern]),
+            compile_group([pattern for pattern in patterns if '/' in pattern]))
+
+def _matches(compiled, name, rel_path):
+    name_regex, path_regex = compiled
+    return bool((name_regex and name_regex.match(os.path.normcase(name)))
+                or (path_regex and path_regex.match(os.path.normcase(rel_path))))
+
+_EXCEL_NAMES = _compile_patterns(EXCEL_PATTERNS)
+_IGNORED_NAMES = _compile_patterns(IGNORED_PATTERNS)
+
+def is_excel_file_name(name):
+    """文件名是需要处理的送货单（不是锁文件、临时文件或备份文件）"""
+    return _matches(_EXCEL_NAMES, name, name) and not _matches(_IGNORED_NAMES, name, name)
+
+def scan_excel_files(raw_data_dir, include=None, exclude=None, progress=None):
+    """用os.scandir遍历一次目录（含子目录），返回按路径排序的[(文件路径, (大小, 修改时间ns))]
+
+    include为要处理的文件的模式（默认为EXCEL_PATTERNS），exclude为额外跳过的文件或目录的模式，
+    IGNORED_PATTERNS中的文件总是跳过。不含/的模式匹配文件名或目录名，含/的模式匹配相对于
+    raw_data_dir的路径（如 "2023/备份/*"）；被跳过的目录不再进入。
+    无法读取的目录（如网络共享断开或没有权限）跳过，并向progress发送discovery阶段的错误事件。
+    """
+    progress = progress or print_progress
+    include = _compile_patterns(include or EXCEL_PATTERNS)
+    exclude = _compile_patterns(IGNORED_PATTERNS + tuple(exclude or ()))
+
+    found = []
+    pending = [(os.fspath(raw_data_dir), '')]
+    while pending:
+        directory, prefix = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                entries = list(entries)
+        except OSError as e:
+            notify(progress, 'discovery', f"无法读取目录 {directory}，其中的送货单已跳过: {e}",
+                    level='error', directory=str(directory))
+            continue
+
+        for entry in entries:
+            rel_path = prefix + entry.name
+            if _matches(exclude, entry.name, rel_path):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append((entry.path, rel_path + '/'))
+                elif _matches(include, entry.name, rel_path) and entry.is_file():
+                    # Windows上scandir已带有文件信息，不需要再访问文件
+                    stat = entry.stat()
+                    found.append((rel_path.split('/'), entry.path, (stat.st_size, stat.st_mtime_ns)))
+            except OSError:
+                # 遍历期间被删除的文件
+                continue
+
+    # 按路径的各级名称排序（与Path的排序相同），比较字符串列表比比较Path对象快得多
+    found.sort(key=lambda item: item[0])
+    return [(Path(path), signature) for _, path, signature in found]
+
+def find_excel_files(raw_data_dir, include=None, exclude=None, progress=None):
+    """查找目录（含子目录）下的所有送货单，按路径排序（见scan_excel_files）"""
+    return [file_path for file_path, _ in scan_excel_files(raw_data_dir, include=include, exclude=exclude,
+                                                           progress=progress)]
+
+def _timed_extract(file_path, engine='stream'):
+    """提取单个文件，返回(数据行, 错误, 耗时秒数)"""
+    start = time.perf_counter()
+    data, error = _extract_file(file_path, engine)
+    return data, error, time.perf_counter() - start
+
+def _extract_in_worker(file_path, engine='stream'):
+    """在子进程中提取单个文件，并收集读取库的输出以便主进程按顺序回放"""
+    out, err = io.StringIO(), io.StringIO()
+    with redirect_stdout(out), redirect_stderr(err):
+        data, error, seconds = _timed_extract(file_path, engine)
+    return data, error, seconds, out.getvalue(), err.getvalue()
+
+def iter_extracted_files(excel_files, workers=1, engine='stream', cancel=None, output=None):
+    """逐个返回(文件, 数据行, 错误, 提取耗时秒数)，workers大于1时使用多进程并行处理
+
+    错误为None表示提取成功，否则为(错误信息, 异常堆栈)。
+    结果按excel_files的顺序返回，与串行处理的结果一致。
+    output为接收(文件, 子进程中读取库的输出)的回调，在返回该文件的结果之前调用；
+    为None时写到标准输出和标准错误。
+    cancel被设置后抛出GenerationCancelled，尚未开始的文件不再提取。
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1 or len(excel_files) <= 1:
+        for file_path in excel_files:
+            check_cancelled(cancel)
+            data, error, seconds = _timed_extract(file_path, engine)
+            yield file_path, data, error, seconds
+        return
 
-    # 提取所有数据
+    workers = min(workers, len(excel_files))
+    # 每个任务打包若干文件，减少进程间通信的开销
+    chunksize = max(1, len(excel_files) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        try:
+            results = executor.map(partial(_extract_in_worker, engine=engine), excel_files,
+                                   chunksize=chunksize)
+            for file_path, (data, error, seconds, out, err) in zip(excel_files, results):
+                # 按文件顺序回放子进程中读取库的输出
+                if output is None:
+                    _write_stream(sys.stdout, out)
+                    _write_stream(sys.stderr, err)
+                elif out or err:
+                    output(file_path, out + err)
+                yield file_path, data, error, seconds
+                check_cancelled(cancel)
+        finally:
+            # 取消或出错时丢弃排队中的任务，只等待正在执行的任务结束
+            executor.shutdown(cancel_futures=True)
+
+def extract_all_files(excel_files, workers=1, engine='stream', progress=None):
+    """提取所有文件的数据，workers大于1时使用多进程并行处理
+
+    返回的数据按excel_files的顺序排列，与串行处理的结果一致。
+    progress为进度回调（见print_progress），默认打印日志。
+    """
+    progress = progress or print_progress
     all_data = []
-    for file_path in excel_files:
-        data = extract_data_from_excel(file_path)
+    for done, (file_path, data, error, _) in enumerate(
+            iter_extracted_files(excel_files, workers=workers, engine=engine,
+                                 output=partial(_notify_worker_output, progress)), 1):
+        _notify_extracted(progress, file_path, data, error, done, len(excel_files))
         all_data.extend(data)
+    return all_data
+
+def _notify_worker_output(progress, file_path, text):
+    """把子进程中读取库的输出作为提取阶段的日志发给进度回调（图形界面中也能看到）"""
+    notify(progress, 'extract', text.rstrip('\n'), file=str(file_path))
+
+def _notify_extracted(progress, file_path, data, error, done, total):
+    """报告一个文件的提取结果"""
+    notify(progress, 'extract', f"正在处理: {file_path}", done, total,
+            file=str(file_path), rows=len(data), ok=error is None)
+    if error is not None:
+        notify(progress, 'extract', f"  处理 {file_path} 时出错: {error[0]}", done, total,
+                level='error', file=str(file_path), traceback=error[1])
+
+@lru_cache(maxsize=None)
+def file_cache_key(file_path):
+    """缓存中文件的键（绝对路径）。解析路径需要逐级访问目录，同一路径只解析一次"""
+    return str(Path(file_path).resolve())
+
+def file_signature(file_path):
+    """文件的(大小, 修改时间ns)"""
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+def file_digest(file_path):
+    """计算文件内容的SHA-256哈希"""
+    with open(file_path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+def files_fingerprint(excel_files, digests):
+    """由各文件的内容哈希（digests: 绝对路径 -> 哈希）计算excel_files的指纹，有文件不在digests中时返回None"""
+    digest = hashlib.sha256(str(EXTRACT_CACHE_VERSION).encode())
+    for file_path in excel_files:
+        key = file_cache_key(file_path)
+        if key not in digests:
+            return None
+        digest.update(f'{key}\0{digests[key]}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+class ExtractCache:
+    """送货单提取结果的磁盘缓存
+
+    以文件路径为键，记录文件大小、修改时间和内容哈希。大小和修改时间不变时直接命中；
+    二者变化但内容哈希相同（如文件被复制或touch）时同样命中，否则需要重新解析。
+
+    每个新解析的文件立即追加到日志文件（缓存文件名加.journal）作为检查点，
+    运行中途被取消或崩溃时，下次运行仍可使用已解析的结果；save()后日志文件被删除。
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = Path(cache_file)
+        self.journal_file = self.cache_file.with_name(self.cache_file.name + '.journal')
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        # 未命中文件的签名，解析完成后与结果一起写入缓存
+        self._pending = {}
+        self._journal = None
+        self.load()
+
+    def load(self):
+        """读取缓存文件和检查点日志，版本不符或文件损坏时从空缓存开始"""
+        if self.cache_file.exists():
+            try:
+                with open(self.cache_file, 'rb') as f:
+                    data = pickle.load(f)
+            except Exception as e:
+                print(f"提取缓存无法读取，将重新解析所有文件: {e}")
+            else:
+                if data.get('version') == EXTRACT_CACHE_VERSION:
+                    self.entries = data['entries']
+
+        if self.journal_file.exists():
+            with open(self.journal_file, 'rb') as f:
+                while True:
+                    try:
+                        version, key, entry = pickle.load(f)
+                    except Exception:
+                        # 文件结束，或最后一条记录在写入时被中断
+                        break
+                    if version == EXTRACT_CACHE_VERSION:
+                        self.entries[key] = entry
+
+    def lookup(self, file_path, signature=None):
+        """返回缓存中的数据行，文件为新增或已修改时返回None
+
+        signature为查找文件时得到的(大小, 修改时间ns)，不传时读取文件信息。
+        """
+        key = file_cache_key(file_path)
+        size, mtime = signature or file_signature(file_path)
+        entry = self.entries.get(key)
+
+        if entry and entry['size'] == size and entry['mtime'] == mtime:
+            self.hits += 1
+            return entry['rows']
+
+        digest = file_digest(file_path)
+        if entry and entry['digest'] == digest:
+            entry['size'] = size
+            entry['mtime'] = mtime
+            self.hits += 1
+            return entry['rows']
+
+        self.misses += 1
+        self._pending[key] = (size, mtime, digest)
+        return None
+
+    def digest(self, file_path):
+        """返回lookup时得到的文件内容哈希"""
+        key = file_cache_key(file_path)
+        if key in self._pending:
+            return self._pending[key][2]
+        return self.entries[key]['digest']
+
+    def discard(self, file_path):
+        """不解析lookup未命中的文件（如跳过的重复文件）：清除其待写入的签名，不计为未命中"""
+        if self._pending.pop(file_cache_key(file_path), None) is not None:
+            self.misses -= 1
+
+    def store(self, file_path, rows):
+        """保存新解析文件的数据行，必须先对该文件调用过lookup"""
+        key = file_cache_key(file_path)
+        size, mtime, digest = self._pending.pop(key)
+        entry = {'size': size, 'mtime': mtime, 'digest': digest, 'rows': rows}
+        self.entries[key] = entry
+
+        if self._journal is None:
+            self._journal = open(self.journal_file, 'ab')
+        pickle.dump((EXTRACT_CACHE_VERSION, key, entry), self._journal, protocol=pickle.HIGHEST_PROTOCOL)
+        self._journal.flush()
+
+    def prune(self, excel_files):
+        """删除不在excel_files中的文件（已删除的，或被跳过的重复文件）的缓存记录"""
+        keep = {file_cache_key(file_path) for file_path in excel_files}
+        for key in list(self.entries):
+            if key not in keep:
+                del self.entries[key]
+
+    def fingerprint(self, excel_files):
+        """返回excel_files内容的指纹，有文件未经lookup时返回None
+
+        解析失败的文件不在缓存中，使用lookup时计算的内容哈希。
+        """
+        digests = {key: pending[2] for key, pending in self._pending.items()}
+        digests.update((key, entry['digest']) for key, entry in self.entries.items())
+        return files_fingerprint(excel_files, digests)
+
+    def save(self):
+        """写入缓存文件（先写临时文件再替换，避免中断时损坏缓存），然后删除检查点日志"""
+        tmp_file = self.cache_file.with_name(self.cache_file.name + '.tmp')
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({'version': EXTRACT_CACHE_VERSION, 'entries': self.entries}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.cache_file)
+
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self.journal_file.unlink(missing_ok=True)
+
+def month_of_date(date):
+    """与build_detail_frame相同的规则计算日期所在的月份（YYYY-MM），无法识别的日期返回None"""
+    month = pd.to_datetime(pd.Series([date], dtype=object), errors='coerce').dt.to_period('M').astype(str)[0]
+    return month if isinstance(month, str) and month != 'NaT' else None
+
+# 详细数据的列：重复值很多的文本列用分类类型保存，数值列为float64
+DETAIL_COLUMNS = ['货名', '规格', '数量', '单位', '单价', '金额', '客户', '日期', '文件']
+CATEGORY_COLUMNS = ['货名', '规格', '单位', '客户', '文件']
+NUMERIC_COLUMNS = ['数量', '单价', '金额']
+
+def build_detail_frame(all_data):
+    """由提取的数据行逐列构建详细数据表，并添加月份列
+
+    分类列的类别按字典序排列，排序和分组结果与普通字符串列相同。
+    """
+    columns = {}
+    for name in DETAIL_COLUMNS:
+        values = [row[name] for row in all_data]
+        if name in CATEGORY_COLUMNS:
+            columns[name] = pd.Categorical(values)
+        elif name in NUMERIC_COLUMNS:
+            columns[name] = np.array(values, dtype=np.float64)
+        else:
+            columns[name] = pd.Series(values, dtype=object)
+    df_all = pd.DataFrame(columns)
+
+    # 提取月份
+    df_all['月份'] = pd.Categorical(pd.to_datetime(df_all['日期']).dt.to_period('M').astype(str))
+    return df_all
+
+# 基础汇总的维度
+# 合并文件中详细数据的排序列
+DETAIL_SORT_KEYS = ['货名', '规格', '日期']
+
+CUBE_KEYS = ['客户', '月份', '货名', '规格', '单位']
+PRODUCT_KEYS = ['货名', '规格', '单位']
+
+def build_aggregation_cube(df_all):
+    """一次分组计算客户×月份×产品的基础汇总
+
+    df_all需包含月份列。返回字典：
+    - cube: 每个客户、月份、产品的数量、金额之和及明细行数（订单数）
+    - product_files: 每个产品出现过的文件（去重）
+    """
+    # 没有日期的记录月份为空，保留它们以计入按产品和按客户的汇总
+    cube = df_all.groupby(CUBE_KEYS, sort=False, dropna=False, observed=True).agg(
+        数量=('数量', 'sum'),
+        金额=('金额', 'sum'),
+        订单数=('货名', 'size')
+    ).reset_index()
+    product_files = df_all[PRODUCT_KEYS + ['文件']].drop_duplicates()
+    return {'cube': cube, 'product_files': product_files}
+
+def merge_aggregates(parts):
+    """合并多份build_aggregation_cube的结果（如各月份分区的部分汇总），与对全部明细一次汇总的结果相同"""
+    cube = pd.concat([part['cube'] for part in parts], ignore_index=True)
+    product_files = pd.concat([part['product_files'] for part in parts], ignore_index=True)
+    # 各部分的分类列类别不同，合并后变为普通列，重新转换为分类类型
+    for frame in (cube, product_files):
+        for column in frame.columns:
+            if column in CUBE_KEYS or column in CATEGORY_COLUMNS:
+                frame[column] = pd.Categorical(frame[column])
+    cube = cube.groupby(CUBE_KEYS, sort=False, dropna=False, observed=True)[
+        ['数量', '金额', '订单数']].sum().reset_index()
+    return {'cube': cube, 'product_files': product_files.drop_duplicates()}
+
+def _join_distinct(pairs, keys, column):
+    """按keys分组，把column去重排序后用', '连接"""
+    pairs = pairs[keys + [column]].drop_duplicates().sort_values(keys + [column])
+    return pairs.groupby(keys, observed=True)[column].agg(', '.join)
+
+def build_pivot_sheets(aggregates, report=None):
+    """由基础汇总推导所有透视表，返回{工作表名: DataFrame}
+
+    传入report时记录每个透视表的耗时和行数。
+    """
+    report = report if report is not None else RunReport()
+    cube = aggregates['cube']
+    # 客户列表和客户数只统计有名称的客户
+    named = cube[cube['客户'] != '']
+
+    # 按品名汇总（汇总表在此基础上增加文件列）
+    with report.stage('pivot:按产品分析', rows=len(cube)):
+        df_by_product = cube.groupby(PRODUCT_KEYS, observed=True)[['数量', '金额']].sum()
+        df_by_product['客户'] = _join_distinct(named, PRODUCT_KEYS, '客户').reindex(
+            df_by_product.index, fill_value='')
+        df_by_product['文件'] = _join_distinct(aggregates['product_files'], PRODUCT_KEYS, '文件').reindex(
+            df_by_product.index, fill_value='')
+        df_by_product = df_by_product.reset_index()
+        df_by_product['平均单价'] = (df_by_product['金额'] / df_by_product['数量']).round(2)
+        df_by_product = df_by_product.sort_values('金额', ascending=False)
+        df_summary = df_by_product[['货名', '规格', '单位', '数量', '平均单价', '金额', '客户', '文件']]
+        df_by_product = df_by_product[['货名', '规格', '单位', '数量', '平均单价', '金额', '客户']]
+
+    # 按客户汇总
+    with report.stage('pivot:按客户分析', rows=len(cube)):
+        df_by_customer = cube.groupby('客户', observed=True)[['订单数', '数量', '金额']].sum().reset_index()
+        df_by_customer['平均单价'] = (df_by_customer['金额'] / df_by_customer['数量']).round(2)
+        df_by_customer = df_by_customer.sort_values('金额', ascending=False)
+        df_by_customer = df_by_customer[['客户', '订单数', '数量', '金额', '平均单价']]
+
+    # 按月份汇总
+    with report.stage('pivot:按月份分析', rows=len(cube)):
+        df_by_month = cube.groupby('月份', observed=True)[['订单数', '数量', '金额']].sum()
+        df_by_month['客户数'] = named[['月份', '客户']].drop_duplicates().groupby('月份', observed=True).size().reindex(
+            df_by_month.index, fill_value=0)
+        df_by_month = df_by_month.reset_index()
+        df_by_month['平均订单金额'] = (df_by_month['金额'] / df_by_month['订单数']).round(2)
+        df_by_month = df_by_month[['月份', '订单数', '客户数', '数量', '金额', '平均订单金额']]
+
+    # 客户月度交叉分析
+    with report.stage('pivot:客户月度分析', rows=len(cube)):
+        df_customer_month = cube.groupby(['客户', '月份'], observed=True)[['订单数', '数量', '金额']].sum().reset_index()
+        df_customer_month = df_customer_month.sort_values(['客户', '月份'])
+        df_customer_month = df_customer_month[['客户', '月份', '订单数', '数量', '金额']]
+
+    return {
+        '汇总': df_summary,
+        '按客户分析': df_by_customer,
+        '按产品分析': df_by_product,
+        '按月份分析': df_by_month,
+        '客户月度分析': df_customer_month,
+    }
+
+# pandas to_excel的表头样式
+_HEADER_FONT = Font(bold=True)
+_HEADER_BORDER = Border(left=Side(style='thin'), right=Side(style='thin'),
+                        top=Side(style='thin'), bottom=Side(style='thin'))
+_HEADER_ALIGNMENT = Alignment(horizontal='center', vertical='top')
+
+def _excel_header_cell(ws, value):
+    """与pandas to_excel相同样式的表头单元格"""
+    cell = WriteOnlyCell(ws, value=value)
+    cell.font = _HEADER_FONT
+    cell.border = _HEADER_BORDER
+    cell.alignment = _HEADER_ALIGNMENT
+    return cell
+
+def _excel_row(ws, row):
+    """转换一行数据：空值写为空单元格，日期使用与pandas相同的格式"""
+    values = []
+    for value in row:
+        if isinstance(value, datetime.datetime):
+            if pd.isna(value):
+                value = None
+            else:
+                value = WriteOnlyCell(ws, value=value)
+                value.number_format = 'YYYY-MM-DD HH:MM:SS'
+        elif isinstance(value, datetime.date):
+            value = WriteOnlyCell(ws, value=value)
+            value.number_format = 'YYYY-MM-DD'
+        elif isinstance(value, float) and value != value:
+            value = None
+        values.append(value)
+    return values
+
+def write_merged_workbook(output_file, sheets, streaming=True, report=None, progress=None, cancel=None):
+    """把{工作表名: DataFrame}写入Excel文件
+
+    streaming为True时使用openpyxl的只写模式逐行写入磁盘，内存占用不随行数增长；
+    为False时使用pd.ExcelWriter，整个工作簿在内存中构建后再保存。
+    传入report时记录每个工作表和最后保存文件的耗时；progress在每个工作表写完后收到事件。
+    streaming为True时，cancel被设置后在工作表之间抛出GenerationCancelled，已有的输出文件保持不变。
+    """
+    report = report if report is not None else RunReport()
+    progress = progress or print_progress
+    if not streaming:
+        with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
+            for done, (sheet_name, df) in enumerate(sheets.items(), 1):
+                with report.stage(f'write:{sheet_name}', rows=len(df)):
+                    df.to_excel(writer, sheet_name=sheet_name, index=False)
+                notify(progress, 'write', None, done, len(sheets), sheet=sheet_name, rows=len(df))
+        return
 
-    print(f"\n共提取 {len(all_data)} 条数据记录")
-
-    if not all_data:
-        print("没有找到任何数据")
+    wb = Workbook(write_only=True)
+    for done, (sheet_name, df) in enumerate(sheets.items(), 1):
+        check_cancelled(cancel)
+        with report.stage(f'write:{sheet_name}', rows=len(df)):
+            ws = wb.create_sheet(sheet_name)
+            ws.append([_excel_header_cell(ws, column) for column in df.columns])
+            for row in df.itertuples(index=False, name=None):
+                ws.append(_excel_row(ws, row))
+        notify(progress, 'write', None, done, len(sheets), sheet=sheet_name, rows=len(df))
+    with report.stage('write:保存文件'):
+        wb.save(output_file)
+
+# 重复送货单清单，保存在合并文件所在的目录
+DUPLICATES_FILE = 'duplicate_files.csv'
+
+def report_duplicates(duplicates_file, duplicates, progress):
+    """报告跳过的重复送货单并写入清单（重复文件, 保留的文件）；没有重复时删除旧的清单"""
+    if not duplicates:
+        Path(duplicates_file).unlink(missing_ok=True)
         return
+    # utf-8-sig使Excel能正确显示中文
+    with open(duplicates_file, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['重复文件', '保留的文件'])
+        writer.writerows((str(file_path), str(original)) for file_path, original in duplicates)
+    notify(progress, 'extract', f"跳过 {len(duplicates)} 个重复的送货单（内容与其他文件完全相同），"
+                                 f"清单已保存到 {duplicates_file}")
+
+# 合并文件的格式变化时递增，使合并文件重新写入
+MERGED_FORMAT_VERSION = 1
+
+def _merged_output_fingerprint(input_fingerprint, streaming_writer):
+    """合并文件的输入指纹：所有送货单的内容加上输出格式"""
+    if input_fingerprint is None:
+        return None
+    return hashlib.sha256(json.dumps([MERGED_FORMAT_VERSION, streaming_writer, input_fingerprint])
+                          .encode('utf-8')).hexdigest()
+
+def _merged_output_is_current(checkpoint_file, fingerprint, output_file):
+    """合并文件已按相同的输入写入过，且之后没有被修改"""
+    if fingerprint is None or not checkpoint_file.exists() or not Path(output_file).exists():
+        return False
+    try:
+        with open(checkpoint_file, encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except Exception:
+        return False
+    return (checkpoint.get('fingerprint') == fingerprint
+            and checkpoint.get('mtime') == os.stat(output_file).st_mtime_ns)
+
+def _record_merged_output(checkpoint_file, fingerprint, output_file):
+    """记录合并文件的输入指纹；没有指纹时删除旧记录"""
+    if fingerprint is None:
+        checkpoint_file.unlink(missing_ok=True)
+        return
+    with open(checkpoint_file, 'w', encoding='utf-8') as f:
+        json.dump({'fingerprint': fingerprint, 'mtime': os.stat(output_file).st_mtime_ns}, f)
+
+def _detail_sort_key(row):
+    """详细数据行（build_detail_frame的列顺序）按DETAIL_SORT_KEYS排序的键，与pandas的排序相同：
+    日期列中datetime排在其他值之前"""
+    date = row[7]
+    return row[0], row[1], (0, date) if isinstance(date, datetime.datetime) else (1, str(date))
+
+class SortedDetailRows:
+    """各分区分别排序后的详细数据，按DETAIL_SORT_KEYS归并为一个有序序列
+
+    提供write_merged_workbook用到的columns、len()和itertuples()，逐行读取分区的排序结果，
+    不需要把所有详细数据放入内存。
+    """
+
+    def __init__(self, run_files, columns, rows):
+        self.run_files = run_files
+        self.columns = columns
+        self.rows = rows
+
+    def __len__(self):
+        return self.rows
+
+    @staticmethod
+    def _read_run(run_file):
+        with open(run_file, 'rb') as f:
+            while True:
+                try:
+                    batch = pickle.load(f)
+                except EOFError:
+                    return
+                yield from batch
+
+    def itertuples(self, index=False, name=None):
+        return heapq.merge(*(self._read_run(run_file) for run_file in self.run_files), key=_detail_sort_key)
+
+class MonthPartitions:
+    """按月份保存在磁盘上的数据行分区
+
+    每个送货单的数据行按日期所在的月份追加到分区文件（月份.pkl），没有有效日期的在NO_MONTH分区。
+    读取一个分区时按送货单的顺序排列，与一次性提取时的顺序相同。创建时清空directory。
+    """
+
+    NO_MONTH = 'no-month'
+    # 排序后的详细数据每批写入的行数
+    SORTED_BATCH_ROWS = 10000
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory.mkdir(parents=True)
+        self.row_count = 0
+        self._files = {}
+        self._sorted_runs = []
+        self._columns = None
+
+    def add(self, index, rows):
+        """追加第index个送货单的数据行"""
+        if not rows:
+            return
+        month = month_of_date(rows[0]['日期']) or self.NO_MONTH
+        f = self._files.get(month)
+        if f is None:
+            f = self._files[month] = open(self.directory / f'{month}.pkl', 'ab')
+        pickle.dump((index, rows), f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.row_count += len(rows)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+
+    def months(self):
+        """所有分区的月份，按时间排列，NO_MONTH在最后"""
+        return sorted(self._files)
+
+    def rows(self, month):
+        """读取一个分区的数据行（须在close()之后）"""
+        chunks = []
+        with open(self.directory / f'{month}.pkl', 'rb') as f:
+            while True:
+                try:
+                    chunks.append(pickle.load(f))
+                except EOFError:
+                    break
+        chunks.sort(key=lambda chunk: chunk[0])
+        return [row for _, rows in chunks for row in rows]
+
+    def detail_frame(self, month):
+        """一个分区的详细数据表（见build_detail_frame）"""
+        return build_detail_frame(self.rows(month))
+
+    def save_sorted(self, month, df_sorted):
+        """保存一个分区按DETAIL_SORT_KEYS排序后的详细数据，供sorted_detail()归并"""
+        run_file = self.directory / f'{month}.sorted.pkl'
+        with open(run_file, 'wb') as f:
+            rows = df_sorted.itertuples(index=False, name=None)
+            while batch := list(itertools.islice(rows, self.SORTED_BATCH_ROWS)):
+                pickle.dump(batch, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._sorted_runs.append(run_file)
+        self._columns = list(df_sorted.columns)
+
+    def sorted_detail(self):
+        """归并所有分区的排序结果，得到与整体排序相同的详细数据"""
+        return SortedDetailRows(self._sorted_runs, self._columns, self.row_count)
+
+# 部分汇总文件的格式变化时递增，旧格式的文件不能再合并
+PARTIAL_FORMAT_VERSION = 2
+
+def shard_of(rel_path, count):
+    """相对于raw-data的路径所属的分片（0到count-1）
+
+    按路径的CRC32分配而不是按序号轮流分配，增删文件不会改变其他文件的分片，各机器的提取缓存仍然有效。
+    """
+    return zlib.crc32(rel_path.encode('utf-8')) % count
+
+def _relative_path(file_path, raw_data_dir):
+    """文件相对于raw_data_dir的路径，用/分隔"""
+    return Path(file_path).relative_to(raw_data_dir).as_posix()
+
+def save_partial_aggregates(partial_file, aggregates, files, duplicates):
+    """保存一个分片的部分汇总文件（gzip压缩的pickle）
+
+    aggregates为build_aggregation_cube的结果，分片没有数据时为None；files为分片中保留的
+    [(相对路径, 文件路径, 内容哈希, 数据行)]，duplicates为分片内跳过的[(相对路径, 文件路径, 内容哈希)]。
+    文件中先是汇总和文件清单，然后逐个文件保存全部数据行（合并时生成详细数据和对账单需要），
+    合并时可逐个文件读取。只保存基本类型（DataFrame按列保存为列表，数据行按DETAIL_COLUMNS保存为元组），
+    各机器的pandas版本不同也能读取。先写临时文件再替换，中断时不会留下不完整的文件。
+    """
+    partial_file = Path(partial_file)
+    partial_file.parent.mkdir(parents=True, exist_ok=True)
+    header = {
+        'version': PARTIAL_FORMAT_VERSION,
+        'extract_version': EXTRACT_CACHE_VERSION,
+        'aggregates': None if aggregates is None else {
+            name: frame.to_dict('list') for name, frame in aggregates.items()},
+        'files': [(rel_path, str(file_path), digest, len(rows)) for rel_path, file_path, digest, rows in files],
+        'duplicates': [(rel_path, str(file_path), digest) for rel_path, file_path, digest in duplicates],
+    }
+    tmp_file = partial_file.with_name(partial_file.name + '.tmp')
+    with gzip.open(tmp_file, 'wb') as f:
+        pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+        for _, _, _, rows in files:
+            pickle.dump([tuple(row[column] for column in DETAIL_COLUMNS) for row in rows], f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, partial_file)
+
+def _read_partial_header(f, partial_file):
+    header = pickle.load(f)
+    if (header.get('version'), header.get('extract_version')) != (PARTIAL_FORMAT_VERSION, EXTRACT_CACHE_VERSION):
+        raise ValueError(f"部分汇总文件 {partial_file} 由不同版本的程序生成，请在各分片上用相同版本重新运行")
+    return header
+
+def load_partial_aggregates(partial_file):
+    """读取部分汇总文件中的汇总和文件清单（不读取数据行），汇总还原为DataFrame
+
+    files为[(相对路径, 文件路径, 内容哈希, 数据行数)]。文件由不同版本的程序生成时抛出ValueError。
+    部分汇总文件为pickle，只能读取可信的机器生成的文件。
+    """
+    with gzip.open(partial_file, 'rb') as f:
+        header = _read_partial_header(f, partial_file)
+    if header['aggregates'] is not None:
+        header['aggregates'] = {name: pd.DataFrame(columns) for name, columns in header['aggregates'].items()}
+    return header
+
+def iter_partial_rows(partial_file):
+    """按文件清单的顺序逐个返回部分汇总文件中各文件的数据行（字典的列表）"""
+    with gzip.open(partial_file, 'rb') as f:
+        header = _read_partial_header(f, partial_file)
+        for _ in header['files']:
+            yield [dict(zip(DETAIL_COLUMNS, row)) for row in pickle.load(f)]
+
+def merge_delivery_orders(raw_data_dir='raw-data', output_file='output/merged_delivery_orders.xlsx',
+                          workers=1, use_cache=True, cache_file=None, return_detail=False,
+                          streaming_writer=True, report=None, progress=None, cancel=None, cache=None,
+                          include=None, exclude=None, partition_dir=None, shard=None, shard_file=None):
+    """合并所有送货单
+
+    streaming_writer为True时逐行写入输出文件，内存占用不随详细数据的行数增长。
+
+    return_detail为True时返回(汇总数据, 详细数据)，生成对账单时可直接使用内存中的详细数据，
+    无需再从输出文件读取；没有数据时返回(None, None)。
+
+    workers为并行提取数据的进程数，1表示串行处理，None表示使用全部CPU核心。
+    use_cache为True时只解析新增或修改过的文件，其余文件使用缓存的提取结果；
+    缓存默认保存在输出目录的.extract_cache.pkl中，可通过cache_file指定。
+    长时间运行的程序（如监视模式）可通过cache传入同一个ExtractCache，不必每次重新读取缓存文件；
+    也可传入DeliveryLedger，把提取结果保存在SQLite台账中。
+
+    传入RunReport时记录各阶段和每个文件的耗时，调用方可在运行结束后保存报告。
+    progress为进度回调，接收各阶段的日志和完成数量（见print_progress），默认打印到标准输出。
+
+    cancel为threading.Event等带is_set()的对象，设置后在下一个文件或阶段之间抛出GenerationCancelled。
+    已提取的文件随时写入缓存的检查点，所有文件的内容与上次写入合并文件时相同则不再重写，
+    因此取消或中断后再次运行会从中断处继续。
+
+    include和exclude为查找送货单时包含和跳过的文件模式（见scan_excel_files），
+    锁文件、临时文件和备份文件总是跳过。内容完全相同的送货单（如复制到多个文件夹）只解析并汇总
+    路径排在最前的一份，跳过的文件列在输出目录的duplicate_files.csv和运行报告中。
+
+    partition_dir不为None时按月份分区处理，用于内存放不下全部明细的多年数据：提取的数据行写入
+    该目录下的MonthPartitions，透视表由各分区的部分汇总合并得到，详细数据按分区排序后归并写入，
+    内存占用取决于数据最多的月份。此时总是逐行写入输出文件，return_detail返回的详细数据为
+    MonthPartitions，可传给generate_partitioned_statements。分区模式下宜用DeliveryLedger作为缓存，
+    ExtractCache会把所有缓存的数据行读入内存。
+
+    shard为(序号, 分片数)时只处理属于该分片的文件（见shard_of），用于把送货单分给多台机器处理。
+    shard_file不为None时只提取并汇总，把部分汇总写入该文件后返回其路径，不生成透视表和合并文件；
+    各分片的部分汇总文件由shard_delivery_orders.reduce_partial_aggregates合并。
+    """
+    if shard_file is not None and partition_dir is not None:
+        raise ValueError('分片模式不能与分区模式同时使用')
+    report = report if report is not None else RunReport()
+    progress = progress or print_progress
 
-    # 转换为DataFrame
-    df_all = pd.DataFrame(all_data)
-
-    # 按货名和规格分组，汇总数量和金额
-    print("\n正在合并相同的货名和规格...")
-    df_summary = df_all.groupby(['货名', '规格', '单位']).agg({
-        '数量': 'sum',
-        '金额': 'sum',
-        '客户': lambda x: ', '.join(sorted(set(filter(None, x)))),
-        '文件': lambda x: ', '.join(sorted(set(x)))
-    }).reset_index()
-
-    # 计算平均单价
-    df_summary['平均单价'] = df_summary['金额'] / df_summary['数量']
-    df_summary['平均单价'] = df_summary['平均单价'].round(2)
-
-    # 调整列顺序
-    df_summary = df_summary[['货名', '规格', '单位', '数量', '平均单价', '金额', '客户', '文件']]
-
-    # 按金额降序排列
-    df_summary = df_summary.sort_values('金额', ascending=False)
-
-    # 生成透视分析数据
-    print(f"\n正在生成透视分析...")
-
-    # 1. 按客户汇总
-    df_by_customer = df_all.groupby('客户').agg({
-        '数量': 'sum',
-        '金额': 'sum',
-        '货名': 'count'
-    }).rename(columns={'货名': '订单数'}).reset_index()
-    df_by_customer['平均单价'] = (df_by_customer['金额'] / df_by_customer['数量']).round(2)
-    df_by_customer = df_by_customer.sort_values('金额', ascending=False)
-    df_by_customer = df_by_customer[['客户', '订单数', '数量', '金额', '平均单价']]
-
-    # 2. 按品名汇总
-    df_by_product = df_all.groupby(['货名', '规格', '单位']).agg({
-        '数量': 'sum',
-        '金额': 'sum',
-        '客户': lambda x: ', '.join(sorted(set(filter(None, x))))
-    }).reset_index()
-    df_by_product['平均单价'] = (df_by_product['金额'] / df_by_product['数量']).round(2)
-    df_by_product = df_by_product.sort_values('金额', ascending=False)
-    df_by_product = df_by_product[['货名', '规格', '单位', '数量', '平均单价', '金额', '客户']]
-
-    # 3. 按月份汇总
-    df_all['月份'] = pd.to_datetime(df_all['日期']).dt.to_period('M').astype(str)
-    df_by_month = df_all.groupby('月份').agg({
-        '数量': 'sum',
-        '金额': 'sum',
-        '货名': 'count',
-        '客户': lambda x: len(set(filter(None, x)))
-    }).rename(columns={'货名': '订单数', '客户': '客户数'}).reset_index()
-    df_by_month['平均订单金额'] = (df_by_month['金额'] / df_by_month['订单数']).round(2)
-    df_by_month = df_by_month[['月份', '订单数', '客户数', '数量', '金额', '平均订单金额']]
-
-    # 4. 客户月度交叉分析
-    df_customer_month = df_all.groupby(['客户', '月份']).agg({
-        '数量': 'sum',
-        '金额': 'sum',
-        '货名': 'count'
-    }).rename(columns={'货名': '订单数'}).reset_index()
-    df_customer_month = df_customer_month.sort_values(['客户', '月份'])
-    df_customer_month = df_customer_month[['客户', '月份', '订单数', '数量', '金额']]
-
-    # 保存详细数据和汇总数据到Excel
-    print(f"\n正在保存到 {output_file}...")
-    with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
-        # 汇总数据
-        df_summary.to_excel(writer, sheet_name='汇总', index=False)
-
-        # 详细数据
-        df_all_sorted = df_all.sort_values(['货名', '规格', '日期'])
-        df_all_sorted.to_excel(writer, sheet_name='详细数据', index=False)
-
-        # 透视分析数据
-        df_by_customer.to_excel(writer, sheet_name='按客户分析', index=False)
-        df_by_product.to_excel(writer, sheet_name='按产品分析', index=False)
-        df_by_month.to_excel(writer, sheet_name='按月份分析', index=False)
-        df_customer_month.to_excel(writer, sheet_name='客户月度分析', index=False)
-
-    print(f"\n合并完成！")
-    print(f"汇总数据共 {len(df_summary)} 种品类")
-    print(f"\n透视分析:")
-    print(f"- 客户数: {len(df_by_customer)}")
-    print(f"- 产品数: {len(df_by_product)}")
-    print(f"- 月份数: {len(df_by_month)}")
-    print(f"\n汇总预览:")
-    print(df_summary.to_string())
+    # 创建输出目录
+    output_path = Path(output_file).parent
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    # 查找所有Excel文件
+    with report.stage('discovery') as entry:
+        scanned_files = scan_excel_files(raw_data_dir, include=include, exclude=exclude, progress=progress)
+        if shard is not None:
+            shard_index, shard_count = shard
+            scanned_files = [(file_path, signature) for file_path, signature in scanned_files
+                             if shard_of(_relative_path(file_path, raw_data_dir), shard_count) == shard_index]
+        excel_files = [file_path for file_path, _ in scanned_files]
+        entry['rows'] = len(excel_files)
+
+    notify(progress, 'discovery', f"找到 {len(excel_files)} 个Excel文件\n",
+            len(excel_files), len(excel_files))
+
+    # 提取所有数据，缓存命中的文件不再解析
+    if not use_cache:
+        cache = None
+    elif cache is None:
+        cache = ExtractCache(cache_file or output_path / '.extract_cache.pkl')
+    else:
+        # 复用的缓存只统计本次运行的命中情况
+        cache.hits = cache.misses = 0
+
+    # 分区模式下数据行写入磁盘分区，file_rows只记录已处理的文件
+    partitions = MonthPartitions(partition_dir) if partition_dir is not None else None
+    file_rows = {}
+    pending_files = []
+    pending_indexes = []
+    # 同一张送货单常被复制到多个文件夹：内容相同的文件只保留路径排在最前的一份，其余不解析也不计入汇总
+    originals = {}
+    duplicates = []
+    total = len(excel_files)
+    try:
+        with report.stage('extract') as entry:
+            for index, (file_path, signature) in enumerate(scanned_files):
+                rows = cache.lookup(file_path, signature) if cache else None
+                digest = cache.digest(file_path) if cache else file_digest(file_path)
+                original = originals.setdefault(digest, file_path)
+                if original is not file_path:
+                    duplicates.append((file_path, original))
+                    report.add_duplicate(file_path, original)
+                    if cache:
+                        cache.discard(file_path)
+                    notify(progress, 'extract', f"跳过重复的送货单: {file_path}（与 {original} 相同）",
+                            len(file_rows) + len(duplicates), total,
+                            file=str(file_path), rows=0, ok=True, duplicate_of=str(original))
+                elif rows is None:
+                    pending_files.append(file_path)
+                    pending_indexes.append(index)
+                else:
+                    file_rows[file_path] = _keep_rows(partitions, index, rows)
+                    report.add_file(file_path, 0.0, len(rows), cached=True)
+                    notify(progress, 'extract', None, len(file_rows) + len(duplicates), total,
+                            file=str(file_path), rows=len(rows), ok=True, cached=True)
+
+            done = len(file_rows) + len(duplicates)
+            extracted = iter_extracted_files(pending_files, workers=workers, cancel=cancel,
+                                             output=partial(_notify_worker_output, progress))
+            for index, (file_path, data, error, seconds) in zip(pending_indexes, extracted):
+                file_rows[file_path] = _keep_rows(partitions, index, data)
+                done += 1
+                report.add_file(file_path, seconds, len(data), ok=error is None)
+                _notify_extracted(progress, file_path, data, error, done, total)
+                # 解析失败的文件不缓存，下次运行时重试并再次报告错误
+                if cache and error is None:
+                    cache.store(file_path, data)
+
+            all_data = []
+            for file_path in excel_files:
+                all_data.extend(file_rows.get(file_path, ()))
+            row_count = partitions.row_count if partitions else len(all_data)
+            entry['rows'] = row_count
+    finally:
+        if partitions:
+            partitions.close()
+        # 重复的送货单不保留在缓存中，台账按客户、月份查询时不会重复计算
+        duplicate_files = {file_path for file_path, _ in duplicates}
+        kept_files = [file_path for file_path in excel_files if file_path not in duplicate_files]
+        # 取消或出错时也保存已提取的文件
+        if cache:
+            with report.stage('cache_save'):
+                cache.prune(kept_files)
+                cache.save()
+
+    notify(progress, 'extract', f"\n共提取 {row_count} 条数据记录", total, total)
+
+    if shard_file is not None:
+        # 分片模式：只汇总本分片的数据，重复的送货单由合并时统一报告
+        with report.stage('aggregation_cube', rows=row_count):
+            aggregates = build_aggregation_cube(build_detail_frame(all_data)) if row_count else None
+        with report.stage('write_partial', rows=row_count):
+            digests = {file_path: digest for digest, file_path in originals.items()}
+            save_partial_aggregates(
+                shard_file, aggregates,
+                [(_relative_path(file_path, raw_data_dir), file_path, digest, file_rows[file_path])
+                 for digest, file_path in originals.items()],
+                [(_relative_path(file_path, raw_data_dir), file_path, digests[original])
+                 for file_path, original in duplicates])
+        notify(progress, 'write', f"\n部分汇总已保存到 {shard_file}")
+        return Path(shard_file)
+
+    report_duplicates(output_path / DUPLICATES_FILE, duplicates, progress)
+
+    if not row_count:
+        notify(progress, 'summary', "没有找到任何数据", level='error')
+        if cache:
+            notify(progress, 'summary', f"提取缓存: 命中 {cache.hits} 个文件，未命中 {cache.misses} 个文件")
+        if return_detail:
+            return None, None
+        return
 
+    check_cancelled(cancel)
+
+    if partitions:
+        # 逐个分区汇总并排序，只有一个月份的详细数据在内存中
+        notify(progress, 'aggregate', "\n正在按月份合并相同的货名和规格...")
+        parts = []
+        for done, month in enumerate(partitions.months(), 1):
+            check_cancelled(cancel)
+            with report.stage(f'partition:{month}') as entry:
+                df_month = partitions.detail_frame(month)
+                entry['rows'] = len(df_month)
+                parts.append(build_aggregation_cube(df_month))
+                partitions.save_sorted(month, df_month.sort_values(DETAIL_SORT_KEYS))
+            del df_month
+            notify(progress, 'aggregate', None, done, len(partitions.months()), month=month)
+        with report.stage('aggregation_cube', rows=row_count) as entry:
+            aggregates = merge_aggregates(parts)
+            entry['cube_rows'] = len(aggregates['cube'])
+    else:
+        # 逐列转换为DataFrame（含月份列）
+        with report.stage('detail_frame', rows=row_count):
+            df_all = build_detail_frame(all_data)
+
+        # 一次分组得到客户×月份×产品的基础汇总，所有透视表都由它推导
+        notify(progress, 'aggregate', "\n正在合并相同的货名和规格...")
+        with report.stage('aggregation_cube', rows=len(df_all)) as entry:
+            aggregates = build_aggregation_cube(df_all)
+            entry['cube_rows'] = len(aggregates['cube'])
+
+    notify(progress, 'pivot', f"\n正在生成透视分析...")
+    sheets = build_pivot_sheets(aggregates, report=report)
+    df_summary = sheets['汇总']
+    df_by_customer = sheets['按客户分析']
+    df_by_product = sheets['按产品分析']
+    df_by_month = sheets['按月份分析']
+    df_customer_month = sheets['客户月度分析']
+
+    if partitions:
+        # 各分区已排序，写入时归并
+        df_all_sorted = partitions.sorted_detail()
+        streaming_writer = True
+    else:
+        with report.stage('sort_detail', rows=len(df_all)):
+            df_all_sorted = df_all.sort_values(DETAIL_SORT_KEYS)
+
+    # 保存详细数据和汇总数据到Excel，输入与上次写入时相同则跳过
+    checkpoint_file = output_path / f'.{Path(output_file).name}.checkpoint.json'
+    fingerprint = _merged_output_fingerprint(cache.fingerprint(kept_files) if cache else None,
+                                             streaming_writer)
+    if _merged_output_is_current(checkpoint_file, fingerprint, output_file):
+        notify(progress, 'write', f"\n合并文件未变化，跳过写入: {output_file}", 6, 6)
+    else:
+        check_cancelled(cancel)
+        notify(progress, 'write', f"\n正在保存到 {output_file}...", 0, 6)
+        write_merged_workbook(output_file, {
+            # 汇总数据
+            '汇总': df_summary,
+            # 详细数据
+            '详细数据': df_all_sorted,
+            # 透视分析数据
+            '按客户分析': df_by_customer,
+            '按产品分析': df_by_product,
+            '按月份分析': df_by_month,
+            '客户月度分析': df_customer_month,
+        }, streaming=streaming_writer, report=report, progress=progress, cancel=cancel)
+        _record_merged_output(checkpoint_file, fingerprint, output_file)
+
+    lines = [
+        f"\n合并完成！",
+        f"汇总数据共 {len(df_summary)} 种品类",
+        f"\n透视分析:",
+        f"- 客户数: {len(df_by_customer)}",
+        f"- 产品数: {len(df_by_product)}",
+        f"- 月份数: {len(df_by_month)}",
+    ]
+    if cache:
+        lines.append(f"\n提取缓存: 命中 {cache.hits} 个文件，未命中 {cache.misses} 个文件")
+    lines += [f"\n汇总预览:", df_summary.to_string()]
+    for line in lines:
+        notify(progress, 'summary', line)
+
+    if return_detail:
+        return df_summary, partitions if partitions else df_all_sorted
     return df_summary
 
+def _keep_rows(partitions, index, rows):
+    """分区模式下把第index个文件的数据行写入分区，返回留在内存中的数据行"""
+    if partitions is None:
+        return rows
+    partitions.add(index, rows)
+    return ()
+
+def prepare_statement_data(df_all):
+    """整理详细数据用于生成对账单
+
+    转换日期列为datetime类型并添加年月列，去掉没有客户名称的记录。
+    """
+    df_all = df_all[df_all['客户'].notna() & (df_all['客户'] != '')]
+    dates = pd.to_datetime(df_all['日期'])
+    return df_all.assign(日期=dates, 年月=dates.dt.to_period('M'))
+
 def amount_to_chinese(amount):
     """将金额转换为中文大写"""
     chinese_numbers = ['零', '壹', '贰', '叁', '肆', '伍', '陆', '柒', '捌', '玖']
@@ -239,211 +1497,579 @@ def amount_to_chinese(amount):
 
     return result
 
+def _register_statement_styles(wb):
+    """在工作簿中注册对账单表格用到的命名样式"""
+    thin_side = Side(style='thin')
+    thin_border = Border(left=thin_side, right=thin_side, top=thin_side, bottom=thin_side)
+
+    wb.add_named_style(NamedStyle(
+        name='statement_header',
+        font=Font(name='宋体', size=11, bold=True),
+        alignment=Alignment(horizontal='center', vertical='center'),
+        fill=PatternFill(start_color='D3D3D3', end_color='D3D3D3', fill_type='solid'),
+        border=thin_border
+    ))
+    wb.add_named_style(NamedStyle(
+        name='statement_cell',
+        font=Font(name='宋体', size=10),
+        alignment=Alignment(horizontal='center', vertical='center'),
+        border=thin_border
+    ))
+    wb.add_named_style(NamedStyle(
+        name='statement_wrap',
+        font=Font(name='宋体', size=10),
+        alignment=Alignment(horizontal='center', vertical='center', wrap_text=True),
+        border=thin_border
+    ))
+
+def _format_statement_date(date_obj):
+    """格式化日期 - 只显示日期部分"""
+    if hasattr(date_obj, 'strftime'):
+        return date_obj.strftime('%Y-%m-%d')
+    return str(date_obj).split('T')[0] if 'T' in str(date_obj) else str(date_obj)
+
+class StatementTemplate:
+    """对账单模板：标题、地址、联系方式、列宽、表头和打印设置只构建一次
+
+    render()为每个客户月份填入客户信息和明细行并保存，然后清除这些内容，
+    同一模板可依次生成多个对账单，每个对账单的耗时主要取决于明细行数。
+    """
+
+    # 第1~5行为固定的抬头和表头，明细从第6行开始
+    FIRST_DATA_ROW = 6
+
+    def __init__(self, company_name, address, phone, fax):
+        # 创建工作簿
+        self.wb = Workbook()
+        ws = self.ws = self.wb.active
+        ws.title = '对账单'
+
+        # 设置列宽
+        ws.column_dimensions['A'].width = 12
+        ws.column_dimensions['B'].width = 20
+        ws.column_dimensions['C'].width = 8
+        ws.column_dimensions['D'].width = 10
+        ws.column_dimensions['E'].width = 10
+        ws.column_dimensions['F'].width = 12
+        ws.column_dimensions['G'].width = 12
+
+        # 标题行 (第1行)
+        ws.merge_cells('A1:G1')
+        title_cell = ws['A1']
+        title_cell.value = company_name
+        title_cell.font = Font(name='宋体', size=18, bold=True)
+        title_cell.alignment = Alignment(horizontal='center', vertical='center')
+        ws.row_dimensions[1].height = 30
+
+        # 地址行 (第2行)
+        ws.merge_cells('A2:G2')
+        address_cell = ws['A2']
+        address_cell.value = f'地址：{address}'
+        address_cell.font = Font(name='宋体', size=10)
+        address_cell.alignment = Alignment(horizontal='center', vertical='center')
+
+        # 联系方式行 (第3行)
+        ws.merge_cells('A3:G3')
+        contact_cell = ws['A3']
+        contact_cell.value = f'电话：{phone}    传真：{fax}'
+        contact_cell.font = Font(name='宋体', size=10)
+        contact_cell.alignment = Alignment(horizontal='center', vertical='center')
+
+        # 客户和日期信息 (第4行)，内容由render()填入
+        ws.merge_cells('A4:B4')
+        ws['A4'].alignment = Alignment(horizontal='left')
+        ws.merge_cells('C4:E4')
+        ws['C4'].alignment = Alignment(horizontal='center')
+
+        # 表格样式每个工作簿注册一次，单元格只引用样式名
+        _register_statement_styles(self.wb)
+
+        # 表头 (第5行)
+        headers = ['送货日期', '品名规格', '单位', '数量', '单价', '金额', '备注']
+        for col_num, header in enumerate(headers, 1):
+            cell = ws.cell(row=5, column=col_num, value=header)
+            cell.style = 'statement_header'
+
+        # 设置打印选项
+        ws.page_setup.paperSize = 9  # A4纸
+        ws.page_setup.orientation = 'portrait'  # 纵向
+        ws.page_setup.fitToWidth = 1  # 适配宽度为1页
+        ws.page_setup.fitToHeight = 0  # 高度不限制（自动）
+
+        # 设置页边距（单位：英寸）
+        ws.page_margins = PageMargins(
+            left=0.5,
+            right=0.5,
+            top=0.75,
+            bottom=0.75,
+            header=0.3,
+            footer=0.3
+        )
+
+        # 设置打印标题（每页都显示表头）
+        ws.print_title_rows = '1:5'  # 第1到第5行作为打印标题
+
+        # 合计行的字体和对齐方式，所有对账单共用
+        self._summary_font = Font(name='宋体', size=11)
+        self._summary_alignment = Alignment(horizontal='right')
+
+    def render(self, df_all, customer_name, year_month, output_file, progress=None):
+        """生成一个对账单，返回总金额"""
+        progress = progress or print_progress
+        ws = self.ws
+
+        notify(progress, 'statements', f"\n正在生成对账单到 {output_file}...")
+
+        ws['A4'] = f'客户：{customer_name}'
+        ws['C4'] = f'{year_month}对账单'
+
+        # 数据行
+        row_num = self.FIRST_DATA_ROW
+        total_amount = 0
+
+        # 按日期排序数据
+        df_sorted = df_all.sort_values('日期')
+        rows = df_sorted[['日期', '货名', '规格', '单位', '数量', '单价', '金额']].itertuples(index=False, name=None)
+
+        for date_obj, product_name, spec, unit, quantity, unit_price, amount in rows:
+            values = (
+                _format_statement_date(date_obj),
+                f"{product_name} {spec}",
+                unit,
+                quantity,
+                unit_price,
+                amount,
+                ''  # 备注
+            )
+            for col_num, value in enumerate(values, 1):
+                cell = ws.cell(row=row_num, column=col_num, value=value)
+                # 品名规格列设置自动换行
+                cell.style = 'statement_wrap' if col_num == 2 else 'statement_cell'
+
+            total_amount += amount
+            row_num += 1
+
+        # 合计行（空几行后）
+        summary_row = row_num + 2
+        summary_ranges = [f'A{summary_row}:C{summary_row}', f'D{summary_row}:G{summary_row}']
+        ws.merge_cells(summary_ranges[0])
+
+        # 中文大写金额
+        chinese_amount = amount_to_chinese(total_amount)
+        ws[f'A{summary_row}'] = f'合计人民币大写：{chinese_amount}'
+        ws[f'A{summary_row}'].font = self._summary_font
+
+        # 小写金额
+        ws.merge_cells(summary_ranges[1])
+        ws[f'D{summary_row}'] = f'人民币小写：{total_amount:.2f}元'
+        ws[f'D{summary_row}'].font = self._summary_font
+        ws[f'D{summary_row}'].alignment = self._summary_alignment
+
+        # 保存文件，然后清除本对账单的内容，恢复为模板
+        try:
+            self.wb.save(output_file)
+        finally:
+            for cell_range in summary_ranges:
+                ws.unmerge_cells(cell_range)
+            ws.delete_rows(self.FIRST_DATA_ROW, summary_row - self.FIRST_DATA_ROW + 1)
+            # 保存时openpyxl会记下列的分级显示级别，恢复初始值使每个对账单的内容与单独生成时一致
+            ws.column_dimensions.max_outline = None
+
+        notify(progress, 'statements', f"对账单已生成: {output_file}")
+        notify(progress, 'statements', f"总金额: {total_amount:.2f}元 ({chinese_amount})")
+        return total_amount
+
 def create_statement(df_all, customer_name, year_month, output_file='statement.xlsx',
                      company_name='百惠行对账单',
                      address='东莞市黄江镇华南塑胶城区132号',
                      phone='(0769) 83631717',
-                     fax='83637787'):
-    """生成对账单"""
-
-    print(f"\n正在生成对账单到 {output_file}...")
-
-    # 创建工作簿
-    wb = Workbook()
-    ws = wb.active
-    ws.title = '对账单'
-
-    # 设置列宽
-    ws.column_dimensions['A'].width = 12
-    ws.column_dimensions['B'].width = 20
-    ws.column_dimensions['C'].width = 8
-    ws.column_dimensions['D'].width = 10
-    ws.column_dimensions['E'].width = 10
-    ws.column_dimensions['F'].width = 12
-    ws.column_dimensions['G'].width = 12
-
-    # 标题行 (第1行)
-    ws.merge_cells('A1:G1')
-    title_cell = ws['A1']
-    title_cell.value = company_name
-    title_cell.font = Font(name='宋体', size=18, bold=True)
-    title_cell.alignment = Alignment(horizontal='center', vertical='center')
-    ws.row_dimensions[1].height = 30
-
-    # 地址行 (第2行)
-    ws.merge_cells('A2:G2')
-    address_cell = ws['A2']
-    address_cell.value = f'地址：{address}'
-    address_cell.font = Font(name='宋体', size=10)
-    address_cell.alignment = Alignment(horizontal='center', vertical='center')
-
-    # 联系方式行 (第3行)
-    ws.merge_cells('A3:G3')
-    contact_cell = ws['A3']
-    contact_cell.value = f'电话：{phone}    传真：{fax}'
-    contact_cell.font = Font(name='宋体', size=10)
-    contact_cell.alignment = Alignment(horizontal='center', vertical='center')
-
-    # 客户和日期信息 (第4行)
-    ws.merge_cells('A4:B4')
-    ws['A4'] = f'客户：{customer_name}'
-    ws['A4'].alignment = Alignment(horizontal='left')
-    ws.merge_cells('C4:E4')
-    ws['C4'] = f'{year_month}对账单'
-    ws['C4'].alignment = Alignment(horizontal='center')
-
-    # 表头 (第5行)
-    headers = ['送货日期', '品名规格', '单位', '数量', '单价', '金额', '备注']
-    for col_num, header in enumerate(headers, 1):
-        cell = ws.cell(row=5, column=col_num)
-        cell.value = header
-        cell.font = Font(name='宋体', size=11, bold=True)
-        cell.alignment = Alignment(horizontal='center', vertical='center')
-        cell.fill = PatternFill(start_color='D3D3D3', end_color='D3D3D3', fill_type='solid')
-
-    # 边框样式
-    thin_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-
-    # 数据行
-    row_num = 6
-    total_amount = 0
-
-    # 按日期排序数据
-    df_sorted = df_all.sort_values('日期')
-
-    for _, row_data in df_sorted.iterrows():
-        # 格式化日期 - 只显示日期部分
-        date_obj = row_data['日期']
-        if hasattr(date_obj, 'strftime'):
-            date_str = date_obj.strftime('%Y-%m-%d')
-        else:
-            date_str = str(date_obj).split('T')[0] if 'T' in str(date_obj) else str(date_obj)
-
-        ws.cell(row=row_num, column=1, value=date_str)
-        ws.cell(row=row_num, column=2, value=f"{row_data['货名']} {row_data['规格']}")
-        ws.cell(row=row_num, column=3, value=row_data['单位'])
-        ws.cell(row=row_num, column=4, value=row_data['数量'])
-        ws.cell(row=row_num, column=5, value=row_data['单价'])
-        ws.cell(row=row_num, column=6, value=row_data['金额'])
-        ws.cell(row=row_num, column=7, value='')  # 备注
-
-        total_amount += row_data['金额']
-
-        # 设置对齐和边框
-        for col_num in range(1, 8):
-            cell = ws.cell(row=row_num, column=col_num)
-            # 品名规格列设置自动换行
-            if col_num == 2:
-                cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-            else:
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.border = thin_border
-            cell.font = Font(name='宋体', size=10)
-
-        row_num += 1
-
-    # 为表格添加边框（包括表头）
-    for col_num in range(1, 8):
-        ws.cell(row=5, column=col_num).border = thin_border
-
-    # 合计行（空几行后）
-    summary_row = row_num + 2
-    ws.merge_cells(f'A{summary_row}:C{summary_row}')
-
-    # 中文大写金额
-    chinese_amount = amount_to_chinese(total_amount)
-    ws[f'A{summary_row}'] = f'合计人民币大写：{chinese_amount}'
-    ws[f'A{summary_row}'].font = Font(name='宋体', size=11)
-
-    # 小写金额
-    ws.merge_cells(f'D{summary_row}:G{summary_row}')
-    ws[f'D{summary_row}'] = f'人民币小写：{total_amount:.2f}元'
-    ws[f'D{summary_row}'].font = Font(name='宋体', size=11)
-    ws[f'D{summary_row}'].alignment = Alignment(horizontal='right')
-
-    # 设置打印选项
-    ws.page_setup.paperSize = 9  # A4纸
-    ws.page_setup.orientation = 'portrait'  # 纵向
-    ws.page_setup.fitToWidth = 1  # 适配宽度为1页
-    ws.page_setup.fitToHeight = 0  # 高度不限制（自动）
-
-    # 设置页边距（单位：英寸）
-    ws.page_margins = PageMargins(
-        left=0.5,
-        right=0.5,
-        top=0.75,
-        bottom=0.75,
-        header=0.3,
-        footer=0.3
-    )
-
-    # 设置打印标题（每页都显示表头）
-    ws.print_title_rows = '1:5'  # 第1到第5行作为打印标题
-
-    # 保存文件
-    wb.save(output_file)
-    print(f"对账单已生成: {output_file}")
-    print(f"总金额: {total_amount:.2f}元 ({chinese_amount})")
+                     fax='83637787', progress=None):
+    """生成对账单
+
+    progress为进度回调（见print_progress），默认打印日志。
+    批量生成时使用StatementTemplate，抬头部分只构建一次。
+    """
+    template = StatementTemplate(company_name, address, phone, fax)
+    template.render(df_all, customer_name, year_month, output_file, progress=progress)
+
+# 生成对账单用到的列，传给子进程时只发送这些列
+STATEMENT_COLUMNS = ['日期', '货名', '规格', '单位', '数量', '单价', '金额']
+
+# 对账单版式变化时递增，使所有对账单重新生成
+STATEMENT_FORMAT_VERSION = 1
+
+def statement_header_options(statement_options=None):
+    """对账单的抬头参数：以create_statement的默认值为基础，用statement_options覆盖"""
+    options = {
+        name: param.default
+        for name, param in inspect.signature(create_statement).parameters.items()
+        if name in ('company_name', 'address', 'phone', 'fax')
+    }
+    options.update(statement_options or {})
+    return options
+
+def statement_fingerprint(group_data, customer_name, year_month, statement_options=None):
+    """计算对账单输入的指纹：明细行内容（与行顺序无关）加上客户、年月和抬头参数"""
+    options = statement_header_options(statement_options)
+
+    row_hashes = np.sort(pd.util.hash_pandas_object(group_data[STATEMENT_COLUMNS], index=False).to_numpy())
+    digest = hashlib.sha256()
+    digest.update(json.dumps([STATEMENT_FORMAT_VERSION, customer_name, year_month, options],
+                             ensure_ascii=False, sort_keys=True).encode('utf-8'))
+    digest.update(row_hashes.tobytes())
+    return digest.hexdigest()
+
+class StatementManifest:
+    """对账单清单，记录每个对账单生成时的输入指纹
+
+    指纹不变且文件仍存在的对账单无需重新生成，也不必打开文件。
+    每生成一个对账单立即追加到日志文件（清单文件名加.journal）作为检查点，
+    运行中途被取消或崩溃时，已生成的对账单在下次运行时跳过；save()后日志文件被删除。
+    """
+
+    def __init__(self, manifest_file):
+        self.manifest_file = Path(manifest_file)
+        self.journal_file = self.manifest_file.with_name(self.manifest_file.name + '.journal')
+        self.entries = {}
+        self._journal = None
+        self.load()
+
+    def load(self):
+        """读取清单文件和检查点日志，文件损坏时从空清单开始（所有对账单重新生成）"""
+        if self.manifest_file.exists():
+            try:
+                with open(self.manifest_file, encoding='utf-8') as f:
+                    self.entries = json.load(f)['statements']
+            except Exception as e:
+                print(f"对账单清单无法读取，将重新生成所有对账单: {e}")
+
+        if self.journal_file.exists():
+            with open(self.journal_file, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        key, fingerprint = json.loads(line)
+                    except ValueError:
+                        # 最后一行在写入时被中断
+                        break
+                    self.entries[key] = fingerprint
+
+    def is_current(self, key, fingerprint, output_file):
+        """对账单已按相同的输入生成过"""
+        return self.entries.get(key) == fingerprint and Path(output_file).exists()
+
+    def record(self, key, fingerprint):
+        self.entries[key] = fingerprint
+
+        if self._journal is None:
+            self._journal = open(self.journal_file, 'a', encoding='utf-8')
+        self._journal.write(json.dumps([key, fingerprint], ensure_ascii=False) + '\n')
+        self._journal.flush()
+
+    def discard(self, key):
+        """删除一个对账单的记录（save()时写入清单文件）"""
+        self.entries.pop(key, None)
+
+    def save(self):
+        """写入清单文件（先写临时文件再替换），然后删除检查点日志"""
+        tmp_file = self.manifest_file.with_name(self.manifest_file.name + '.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'statements': self.entries}, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.manifest_file)
+
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self.journal_file.unlink(missing_ok=True)
+
+def statement_output_file(output_dir, customer, year_month):
+    """对账单的保存路径：输出目录/客户/statement_客户_年月.xlsx"""
+    return Path(output_dir) / customer / f'statement_{customer}_{year_month}.xlsx'
+
+def statement_title_month(year_month):
+    """对账单标题中的年月，如2023年1月"""
+    return f'{year_month.year}年{year_month.month}月'
+
+def _render_statement(template, task, progress):
+    """用模板生成一个对账单，返回耗时秒数"""
+    group_data, customer, year_month_str, output_file = task
+    start = time.perf_counter()
+    template.render(group_data, customer, year_month_str, output_file, progress=progress)
+    return time.perf_counter() - start
+
+# 子进程中的对账单模板，由_init_statement_worker在进程启动时构建
+_worker_template = None
+
+def _init_statement_worker(header_options):
+    global _worker_template
+    _worker_template = StatementTemplate(**header_options)
+
+def _render_statement_in_worker(task):
+    """在子进程中生成一个对账单，返回(进度事件, 耗时秒数)以便主进程回放"""
+    events = []
+    seconds = _render_statement(_worker_template, task, events.append)
+    return events, seconds
+
+class StatementBatch:
+    """一次批量生成对账单：所有客户月份共用一个对账单清单、一个模板和一个进程池
+
+    generate_statements调用一次add，generate_partitioned_statements对每个月份各调用一次add，
+    进程池只启动一次，清单只读写一次。参数同generate_statements；close()时关闭进程池并保存清单。
+    所有数据add()之后调用remove_stale()删除不再有数据的客户月份的对账单。
+    """
+
+    def __init__(self, output_dir='output', workers=1, report=None, progress=None, cancel=None,
+                 statement_options=None):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.report = report if report is not None else RunReport()
+        self.progress = progress or print_progress
+        self.cancel = cancel
+        self.statement_options = statement_options
+        # 抬头固定的部分由StatementTemplate构建一次，供所有对账单使用
+        self.header_options = statement_header_options(statement_options)
+        self.manifest = StatementManifest(self.output_dir / '.statement_manifest.json')
+        self.generated_count = 0
+        self.skipped_count = 0
+        self.removed_count = 0
+        # 本次add()过的所有对账单（清单中的键）
+        self._keys = set()
+        self._template = None
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _render_locally(self, task):
+        if self._template is None:
+            self._template = StatementTemplate(**self.header_options)
+        return _render_statement(self._template, task, self.progress)
+
+    def _render_in_pool(self, tasks):
+        """在进程池中生成对账单，按任务顺序返回(进度事件, 耗时秒数)"""
+        if self._executor is None:
+            # 每个子进程启动时构建一次模板
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_statement_worker,
+                                                 initargs=(self.header_options,))
+        chunksize = max(1, len(tasks) // (self.workers * 4))
+        return self._executor.map(_render_statement_in_worker, tasks, chunksize=chunksize)
+
+    def add(self, df_all):
+        """为df_all（prepare_statement_data()整理后的详细数据）中每个客户月份生成对账单
+
+        返回这部分数据的(新生成数量, 跳过数量)。
+        """
+        progress = self.progress
+        output_dir = self.output_dir
+        manifest = self.manifest
+
+        # 按客户和年月分组
+        grouped = df_all.groupby(['客户', '年月'], observed=True)
+        total = len(grouped)
+        notify(progress, 'statements', f"共有 {total} 个客户月份组合\n", 0, total)
+
+        skipped_count = 0
+        tasks = []
+        fingerprints = []
+        for (customer, year_month), group_data in grouped:
+            # 生成文件名
+            output_file = statement_output_file(output_dir, customer, year_month)
+            customer_dir = output_file.parent
+            key = output_file.relative_to(output_dir).as_posix()
+            self._keys.add(key)
+
+            # 输入没有变化的对账单跳过
+            group_data = group_data[STATEMENT_COLUMNS]
+            fingerprint = statement_fingerprint(group_data, customer, str(year_month), self.statement_options)
+            if manifest.is_current(key, fingerprint, output_file):
+                skipped_count += 1
+                notify(progress, 'statements', f"\n对账单未变化，跳过: {output_file}", skipped_count, total,
+                        file=str(output_file), rows=len(group_data), status='skipped')
+                continue
+
+            # 创建客户文件夹
+            customer_dir.mkdir(exist_ok=True)
+
+            # 格式化年月显示
+            year_month_str = statement_title_month(year_month)
+            # 去掉未用到的类别，避免每个任务都附带完整的类别表
+            for column in CATEGORY_COLUMNS:
+                if column in group_data and isinstance(group_data[column].dtype, pd.CategoricalDtype):
+                    group_data[column] = group_data[column].cat.remove_unused_categories()
+            tasks.append((group_data, customer, year_month_str, str(output_file)))
+            fingerprints.append((key, fingerprint))
+
+        generated_count = 0
+
+        def finish(task, seconds, key, fingerprint):
+            """记录一个已生成的对账单"""
+            nonlocal generated_count
+            generated_count += 1
+            self.report.add_statement(task[3], seconds, len(task[0]))
+            manifest.record(key, fingerprint)
+            notify(progress, 'statements', None, skipped_count + generated_count, total,
+                    file=task[3], rows=len(task[0]), status='generated', seconds=seconds)
+
+        try:
+            with self.report.stage('statements', rows=len(tasks)):
+                if self.workers <= 1 or len(tasks) <= 1:
+                    for task, (key, fingerprint) in zip(tasks, fingerprints):
+                        check_cancelled(self.cancel)
+                        seconds = self._render_locally(task)
+                        finish(task, seconds, key, fingerprint)
+                else:
+                    results = self._render_in_pool(tasks)
+                    for task, (events, seconds), (key, fingerprint) in zip(tasks, results, fingerprints):
+                        # 按客户月份顺序回放子进程的进度事件
+                        for event in events:
+                            progress(event)
+                        finish(task, seconds, key, fingerprint)
+                        check_cancelled(self.cancel)
+        finally:
+            self.generated_count += generated_count
+            self.skipped_count += skipped_count
+        return generated_count, skipped_count
+
+    def remove_stale(self):
+        """删除清单中有、本次数据中没有的客户月份的对账单，返回删除数量
+
+        这些客户月份的送货单已被删除，或更正后改到了其他客户或月份。须在所有数据add()之后调用，
+        中途取消时不调用，否则未处理的月份的对账单会被误删。
+        """
+        for key in sorted(self.manifest.entries.keys() - self._keys):
+            output_file = self.output_dir / key
+            output_file.unlink(missing_ok=True)
+            self.manifest.discard(key)
+            self.removed_count += 1
+            # 客户的对账单都已删除时，客户文件夹也删除
+            if output_file.parent != self.output_dir:
+                try:
+                    output_file.parent.rmdir()
+                except OSError:
+                    pass
+            notify(self.progress, 'statements', f"\n没有送货记录，删除旧的对账单: {output_file}",
+                    file=str(output_file), status='removed')
+        return self.removed_count
+
+    def close(self):
+        """关闭进程池并保存清单；中途出错或取消时也保存已生成的对账单，下次运行不必重复生成"""
+        try:
+            if self._executor is not None:
+                # 取消或出错时丢弃排队中的任务，只等待正在执行的任务结束
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+        finally:
+            self.manifest.save()
+
+def generate_statements(df_all, output_dir='output', workers=1, report=None, progress=None,
+                        cancel=None, **statement_options):
+    """为每个客户的每个月生成对账单，只重新生成输入有变化的对账单
+
+    df_all为prepare_statement_data()整理后的详细数据。每个对账单的明细行和抬头参数的指纹
+    记录在输出目录的.statement_manifest.json中，指纹不变的对账单直接跳过。
+    workers大于1时使用多进程并行生成，None表示使用全部CPU核心。
+    statement_options为对账单的抬头参数（company_name、address等，默认值与create_statement相同）。
+    传入report时记录每个对账单的耗时和明细行数。
+    progress为进度回调（见print_progress），每个对账单生成或跳过后收到完成数量，默认打印日志。
+    cancel被设置后在对账单之间抛出GenerationCancelled；每个已生成的对账单立即记入清单，
+    再次运行时从中断处继续。
+    清单中已没有送货记录的客户月份（送货单被删除，或改到其他客户或月份）的对账单被删除。
+    返回(新生成数量, 跳过数量)。
+    """
+    with StatementBatch(output_dir, workers=workers, report=report, progress=progress, cancel=cancel,
+                        statement_options=statement_options) as batch:
+        batch.add(df_all)
+        batch.remove_stale()
+    return batch.generated_count, batch.skipped_count
+
+def generate_partitioned_statements(partitions, output_dir='output', workers=1, report=None, progress=None,
+                                    cancel=None, **statement_options):
+    """按月份分区生成对账单，每次只读入一个月份的数据；其余参数和返回值同generate_statements
+
+    partitions为分区模式的merge_delivery_orders返回的MonthPartitions。
+    所有月份共用一个进程池和一个对账单清单（见StatementBatch）。
+    """
+    with StatementBatch(output_dir, workers=workers, report=report, progress=progress, cancel=cancel,
+                        statement_options=statement_options) as batch:
+        for month in partitions.months():
+            # 没有有效日期的记录不生成对账单
+            if month == MonthPartitions.NO_MONTH:
+                continue
+            check_cancelled(cancel)
+            # 与合并后的详细数据相同的顺序
+            batch.add(prepare_statement_data(partitions.detail_frame(month).sort_values(DETAIL_SORT_KEYS)))
+        batch.remove_stale()
+    return batch.generated_count, batch.skipped_count
 
 if __name__ == '__main__':
-    # 合并送货单
-    df_summary = merge_delivery_orders()
-
-    # 读取详细数据用于生成对账单
-    df_all = pd.read_excel('output/merged_delivery_orders.xlsx', sheet_name='详细数据')
-
-    # 转换日期列为datetime类型
-    df_all['日期'] = pd.to_datetime(df_all['日期'])
-
-    # 提取年月
-    df_all['年月'] = df_all['日期'].dt.to_period('M')
-
-    # 按客户和年月分组
-    grouped = df_all.groupby(['客户', '年月'])
+    import argparse
+    import multiprocessing
+
+    multiprocessing.freeze_support()
+
+    parser = argparse.ArgumentParser(description='合并送货单并生成对账单')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='并行提取数据和生成对账单的进程数，1表示串行处理（默认: CPU核心数）')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='不使用提取缓存，重新解析所有文件')
+    parser.add_argument('--include', nargs='+', metavar='PATTERN',
+                        help='只处理匹配这些模式的文件（默认: *.xls *.xlsx）')
+    parser.add_argument('--exclude', nargs='+', metavar='PATTERN',
+                        help='跳过匹配这些模式的文件或目录，含/的模式匹配相对于raw-data的路径')
+    parser.add_argument('--ledger', metavar='FILE',
+                        help='把提取结果保存在SQLite台账中（代替提取缓存），可按客户、月份等查询明细')
+    parser.add_argument('--chunked', action='store_true',
+                        help='按月份分区处理，内存占用取决于数据最多的月份（用于多年的数据；'
+                             '未指定--ledger时使用output/delivery_ledger.sqlite作为缓存）')
+    parser.add_argument('--report', metavar='FILE',
+                        help='把各阶段、每个文件和每个对账单的耗时保存为JSON运行报告')
+    parser.add_argument('--report-top', type=int, default=20, metavar='N',
+                        help='运行报告中列出最慢的N个文件和对账单（默认: 20）')
+    args = parser.parse_args()
+
+    report = RunReport(top_n=args.report_top)
+
+    ledger = None
+    ledger_file = args.ledger
+    if ledger_file is None and args.chunked and not args.no_cache:
+        # 分区模式下提取缓存也不应整个读入内存，改用台账
+        ledger_file = os.path.join('output', 'delivery_ledger.sqlite')
+    if ledger_file:
+        from delivery_ledger import DeliveryLedger
+        os.makedirs(os.path.dirname(ledger_file) or '.', exist_ok=True)
+        ledger = DeliveryLedger(ledger_file)
+
+    # 合并送货单，直接使用内存中（分区模式下为磁盘上）的详细数据生成对账单
+    partition_dir = os.path.join('output', '.partitions') if args.chunked else None
+    df_summary, df_all = merge_delivery_orders(workers=args.workers, use_cache=not args.no_cache,
+                                               return_detail=True, report=report, cache=ledger,
+                                               include=args.include, exclude=args.exclude,
+                                               partition_dir=partition_dir)
+    if df_all is None:
+        if args.report:
+            report.save(args.report)
+        sys.exit(1)
 
     print(f"\n\n===== 开始生成对账单 =====")
-    print(f"共有 {len(grouped)} 个客户月份组合\n")
-
-    # 创建输出目录
-    output_dir = Path('output')
-    output_dir.mkdir(exist_ok=True)
 
     # 为每个客户的每个月生成对账单
-    skipped_count = 0
-    generated_count = 0
-
-    for (customer, year_month), group_data in grouped:
-        # 创建客户文件夹
-        customer_dir = output_dir / customer
-        customer_dir.mkdir(exist_ok=True)
-
-        # 生成文件名
-        output_file = customer_dir / f'statement_{customer}_{year_month}.xlsx'
-
-        # 检查文件是否已存在
-        if output_file.exists():
-            print(f"\n对账单已存在，跳过: {output_file}")
-            skipped_count += 1
-            continue
-
-        # 格式化年月显示
-        year_month_str = f'{year_month.year}年{year_month.month}月'
-
-        # 生成对账单
-        create_statement(
-            group_data,
-            customer_name=customer,
-            year_month=year_month_str,
-            output_file=str(output_file)
-        )
-        generated_count += 1
+    if args.chunked:
+        generated_count, skipped_count = generate_partitioned_statements(df_all, output_dir='output',
+                                                                         workers=args.workers, report=report)
+    else:
+        # 转换日期列并提取年月
+        df_all = prepare_statement_data(df_all)
+        generated_count, skipped_count = generate_statements(df_all, output_dir='output',
+                                                             workers=args.workers, report=report)
 
     print(f"\n\n===== 所有对账单生成完成 =====")
     print(f"新生成: {generated_count} 个对账单")
     print(f"已跳过: {skipped_count} 个对账单")
     print(f"文件保存位置: output/ 文件夹")
+
+    if args.report:
+        report.save(args.report)
+        print(f"运行报告已保存到 {args.report}")
@@ -0,0 +1,248 @@
+"""
+分片处理送货单：把原始数据分给多台机器（或多个进程）提取和汇总，再合并结果
+
+每个分片运行merge_delivery_orders的提取和基础汇总阶段，把部分汇总（客户×月份×产品的汇总、
+产品出现过的文件）和各文件的全部数据行（生成详细数据和对账单需要）写入一个gzip压缩的pickle文件；
+合并步骤读取所有分片的部分汇总文件，生成与单机运行相同的合并文件、重复送货单清单和对账单。
+读取pickle可以执行任意代码，只能合并可信的机器生成的部分汇总文件。
+
+各机器上的raw-data目录结构应相同（共享目录，或复制了相同的目录结构），文件按相对路径分配到分片：
+    uv run shard_delivery_orders.py map --shard 1/3 --partial shard-1.partial      # 在第1台机器上
+    uv run shard_delivery_orders.py reduce shard-*.partial --output output           # 收集后合并
+
+在本机用多个进程代替多台机器：
+    uv run shard_delivery_orders.py local --shards 3
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from pathlib import Path
+
+from merge_delivery_orders import (
+    DETAIL_SORT_KEYS, DUPLICATES_FILE, MonthPartitions, RunReport, build_aggregation_cube,
+    build_detail_frame, build_pivot_sheets, generate_partitioned_statements, iter_partial_rows, load_partial_aggregates,
+    check_cancelled, merge_aggregates, merge_delivery_orders, notify, print_progress, quiet_progress,
+    report_duplicates, write_merged_workbook,
+)
+
+
+def run_shard(shard, shard_count, partial_file, raw_data_dir='raw-data', cache_dir='output', workers=1,
+              use_cache=True, include=None, exclude=None, report=None, progress=None):
+    """提取并汇总第shard个分片（0到shard_count-1）的送货单，写入部分汇总文件，返回其路径
+
+    提取缓存保存在cache_dir中，同一台机器再次运行时只解析变化的文件。
+    """
+    return merge_delivery_orders(raw_data_dir=raw_data_dir,
+                                 output_file=Path(cache_dir) / 'merged_delivery_orders.xlsx',
+                                 workers=workers, use_cache=use_cache, report=report, progress=progress,
+                                 include=include, exclude=exclude,
+                                 shard=(shard, shard_count), shard_file=partial_file)
+
+
+def reduce_partial_aggregates(partial_files, output_dir='output', workers=1, report=None, progress=None,
+                              cancel=None, **statement_options):
+    """合并各分片的部分汇总文件，生成合并文件、重复送货单清单和对账单
+
+    文件按相对路径排列，内容相同的送货单（包括分到不同分片的）只保留路径排在最前的一份，
+    结果与在一台机器上处理全部送货单相同。先只读取各分片的汇总和文件清单，再逐个文件把数据行
+    写入按月份的分区，排序归并后写入详细数据，内存占用取决于数据最多的月份；只有文件与其他分片
+    重复的分片需要把该分片的数据行读入内存重新汇总。部分汇总文件为pickle，只能合并可信的机器生成的文件。
+    返回(新生成数量, 跳过数量)；所有分片都没有数据时返回None。
+    """
+    report = report if report is not None else RunReport()
+    progress = progress or print_progress
+    output_path = Path(output_dir)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    with report.stage('load_partials') as entry:
+        shards = [load_partial_aggregates(partial_file) for partial_file in partial_files]
+        entry['rows'] = len(shards)
+
+    # 所有分片的文件按相对路径排列，与单机运行时的文件顺序相同；
+    # 分片内跳过的重复文件没有数据行，其分片内的序号为None
+    files = sorted([(rel_path.split('/'), shard_no, position, file_path, digest)
+                    for shard_no, shard in enumerate(shards)
+                    for position, (rel_path, file_path, digest, _) in enumerate(shard['files'])]
+                   + [(rel_path.split('/'), shard_no, None, file_path, digest)
+                      for shard_no, shard in enumerate(shards)
+                      for rel_path, file_path, digest in shard['duplicates']],
+                   key=lambda item: item[0])
+
+    originals = {}
+    # (分片, 分片内的序号) -> 在全部文件中的顺序
+    kept = {}
+    duplicates = []
+    # 有文件成为其他分片中文件的重复的分片，需要去掉该文件后重新汇总
+    changed_shards = set()
+    for index, (_, shard_no, position, file_path, digest) in enumerate(files):
+        original = originals.setdefault(digest, index)
+        if original != index:
+            duplicates.append((file_path, files[original][3]))
+            if position is not None:
+                changed_shards.add(shard_no)
+        else:
+            kept[shard_no, position] = index
+
+    notify(progress, 'extract', f"合并 {len(shards)} 个分片的部分汇总：{len(files)} 个文件，"
+                                 f"{sum(shards[shard_no]['files'][position][3] for shard_no, position in kept)} "
+                                 f"条数据记录")
+    report_duplicates(output_path / DUPLICATES_FILE, duplicates, progress)
+
+    # 逐个分片读取数据行，按在全部文件中的顺序写入月份分区
+    partitions = MonthPartitions(output_path / '.partitions')
+    parts = []
+    try:
+        for shard_no, (partial_file, shard) in enumerate(zip(partial_files, shards)):
+            check_cancelled(cancel)
+            with report.stage(f'load_rows:{Path(partial_file).name}') as entry:
+                shard_rows = []
+                row_count = partitions.row_count
+                for position, rows in enumerate(iter_partial_rows(partial_file)):
+                    index = kept.get((shard_no, position))
+                    if index is None:
+                        continue
+                    partitions.add(index, rows)
+                    if shard_no in changed_shards:
+                        shard_rows.extend(rows)
+                entry['rows'] = partitions.row_count - row_count
+            aggregates = shard['aggregates']
+            if shard_no in changed_shards:
+                aggregates = build_aggregation_cube(build_detail_frame(shard_rows)) if shard_rows else None
+            if aggregates is not None:
+                parts.append(aggregates)
+    finally:
+        partitions.close()
+
+    if not parts:
+        notify(progress, 'summary', "没有找到任何数据", level='error')
+        return None
+
+    check_cancelled(cancel)
+    with report.stage('aggregation_cube') as entry:
+        aggregates = merge_aggregates(parts)
+        entry['cube_rows'] = len(aggregates['cube'])
+
+    # 逐个分区排序
+    notify(progress, 'aggregate', "\n正在按月份排序详细数据...")
+    for done, month in enumerate(partitions.months(), 1):
+        check_cancelled(cancel)
+        with report.stage(f'partition:{month}') as entry:
+            df_month = partitions.detail_frame(month)
+            entry['rows'] = len(df_month)
+            partitions.save_sorted(month, df_month.sort_values(DETAIL_SORT_KEYS))
+        del df_month
+        notify(progress, 'aggregate', None, done, len(partitions.months()), month=month)
+
+    notify(progress, 'pivot', f"\n正在生成透视分析...")
+    sheets = build_pivot_sheets(aggregates, report=report)
+
+    output_file = output_path / 'merged_delivery_orders.xlsx'
+    check_cancelled(cancel)
+    notify(progress, 'write', f"\n正在保存到 {output_file}...", 0, 6)
+    write_merged_workbook(output_file, {'汇总': sheets['汇总'], '详细数据': partitions.sorted_detail(), **sheets},
+                          report=report, progress=progress, cancel=cancel)
+    notify(progress, 'summary', f"\n合并完成！汇总数据共 {len(sheets['汇总'])} 种品类，"
+                                 f"客户数: {len(sheets['按客户分析'])}，月份数: {len(sheets['按月份分析'])}")
+
+    notify(progress, 'statements', f"\n\n===== 开始生成对账单 =====")
+    return generate_partitioned_statements(partitions, output_dir=output_dir, workers=workers, report=report,
+                                           progress=progress, cancel=cancel, **statement_options)
+
+
+def _run_local_shard(shard, shard_count, partial_file, raw_data_dir, cache_dir, options):
+    """本机模拟时在子进程中运行一个分片"""
+    run_shard(shard, shard_count, partial_file, raw_data_dir=raw_data_dir, cache_dir=cache_dir,
+              progress=quiet_progress, **options)
+
+
+def run_local(shard_count, raw_data_dir='raw-data', output_dir='output', workers=1, use_cache=True,
+              include=None, exclude=None):
+    """在本机用shard_count个进程代替多台机器运行各分片，再合并结果；返回同reduce_partial_aggregates
+
+    每个分片的提取缓存和部分汇总文件保存在输出目录的.shards/shard-N中。
+    """
+    shards_dir = Path(output_dir) / '.shards'
+    partial_files = [shards_dir / f'shard-{shard + 1}' / f'shard-{shard + 1}-of-{shard_count}.partial'
+                     for shard in range(shard_count)]
+    processes = [multiprocessing.Process(target=_run_local_shard, args=(
+        shard, shard_count, partial_file, raw_data_dir, partial_file.parent,
+        {'workers': workers, 'use_cache': use_cache, 'include': include, 'exclude': exclude}))
+        for shard, partial_file in enumerate(partial_files)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    for shard, process in enumerate(processes):
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"分片 {shard + 1}/{shard_count} 运行失败（退出码 {process.exitcode}）")
+        print(f"分片 {shard + 1}/{shard_count} 完成（{time.perf_counter() - start:.1f} 秒）")
+    return reduce_partial_aggregates(partial_files, output_dir=output_dir, workers=workers)
+
+
+def _parse_shard(value):
+    """把"序号/分片数"（序号从1开始）解析为(序号, 分片数)，序号从0开始"""
+    try:
+        shard, shard_count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"分片应为 序号/分片数，如 1/3: {value}")
+    if not 1 <= shard <= shard_count:
+        raise argparse.ArgumentTypeError(f"分片序号应在1到{shard_count}之间: {value}")
+    return shard - 1, shard_count
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    parser = argparse.ArgumentParser(description='分片处理送货单并合并结果')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    map_parser = subparsers.add_parser('map', help='提取并汇总一个分片的送货单，写入部分汇总文件')
+    map_parser.add_argument('--shard', type=_parse_shard, required=True, metavar='I/N',
+                            help='处理N个分片中的第I个（I从1开始）')
+    map_parser.add_argument('--partial', required=True, metavar='FILE', help='部分汇总文件')
+    map_parser.add_argument('--cache-dir', default='output', help='提取缓存所在的文件夹（默认: output）')
+
+    reduce_parser = subparsers.add_parser('reduce', help='合并所有分片的部分汇总文件，生成合并文件和对账单')
+    reduce_parser.add_argument('partial_files', nargs='+', metavar='FILE', help='各分片的部分汇总文件')
+
+    local_parser = subparsers.add_parser('local', help='在本机用多个进程代替多台机器运行各分片，再合并')
+    local_parser.add_argument('--shards', type=int, default=2, help='分片数（默认: 2）')
+
+    for sub in (map_parser, local_parser):
+        sub.add_argument('--raw-data', default='raw-data', help='原始数据文件夹（默认: raw-data）')
+        sub.add_argument('--no-cache', action='store_true', help='不使用提取缓存，重新解析所有文件')
+        sub.add_argument('--include', nargs='+', metavar='PATTERN',
+                         help='只处理匹配这些模式的文件（默认: *.xls *.xlsx）')
+        sub.add_argument('--exclude', nargs='+', metavar='PATTERN', help='跳过匹配这些模式的文件或目录')
+    for sub in (reduce_parser, local_parser):
+        sub.add_argument('--output', default='output', help='输出文件夹（默认: output）')
+    for sub in (map_parser, reduce_parser, local_parser):
+        sub.add_argument('--workers', type=int, default=1,
+                         help='每个分片提取数据、合并时生成对账单的进程数（默认: 1）')
+    args = parser.parse_args()
+
+    if args.command != 'reduce' and not os.path.isdir(args.raw_data):
+        print(f"原始数据文件夹不存在: {args.raw_data}")
+        sys.exit(1)
+
+    if args.command == 'map':
+        shard, shard_count = args.shard
+        run_shard(shard, shard_count, args.partial, raw_data_dir=args.raw_data, cache_dir=args.cache_dir,
+                  workers=args.workers, use_cache=not args.no_cache, include=args.include, exclude=args.exclude)
+        sys.exit(0)
+
+    if args.command == 'reduce':
+        result = reduce_partial_aggregates(args.partial_files, output_dir=args.output, workers=args.workers)
+    else:
+        result = run_local(args.shards, raw_data_dir=args.raw_data, output_dir=args.output, workers=args.workers,
+                           use_cache=not args.no_cache, include=args.include, exclude=args.exclude)
+    if result is None:
+        sys.exit(1)
+
+    generated_count, skipped_count = result
+    print(f"\n\n===== 所有对账单生成完成 =====")
+    print(f"新生成: {generated_count} 个对账单")
+    print(f"已跳过: {skipped_count} 个对账单")
+    print(f"文件保存位置: {args.output}/ 文件夹")
@@ -2,9 +2,9 @@
 送货单对账单生成工具 - 简化版（无GUI依赖）
 """
 import os
+import multiprocessing
 from pathlib import Path
-from merge_delivery_orders import merge_delivery_orders, create_statement
-import pandas as pd
+from merge_delivery_orders import merge_delivery_orders, generate_statements, prepare_statement_data
 
 
 def main():
@@ -54,59 +54,28 @@ def main():
         # 合并送货单
         output_file = os.path.join(output_dir, 'merged_delivery_orders.xlsx')
         print("📊 正在合并送货单数据...")
-        df_summary = merge_delivery_orders(
+        df_summary, df_all = merge_delivery_orders(
             raw_data_dir=raw_data_dir,
-            output_file=output_file
+            output_file=output_file,
+            workers=os.cpu_count(),
+            return_detail=True
         )
+        if df_all is None:
+            print("❌ 没有可用于生成对账单的数据")
+            input("按回车键退出...")
+            return
 
-        # 读取详细数据用于生成对账单
-        df_all = pd.read_excel(output_file, sheet_name='详细数据')
-
-        # 转换日期列为datetime类型
-        df_all['日期'] = pd.to_datetime(df_all['日期'])
-
-        # 提取年月
-        df_all['年月'] = df_all['日期'].dt.to_period('M')
-
-        # 按客户和年月分组
-        grouped = df_all.groupby(['客户', '年月'])
+        # 转换日期列并提取年月
+        df_all = prepare_statement_data(df_all)
 
         print(f"\n📝 开始生成对账单...")
-        print(f"共有 {len(grouped)} 个客户月份组合\n")
-
-        # 创建输出目录
-        output_path = Path(output_dir)
-        output_path.mkdir(exist_ok=True)
 
         # 为每个客户的每个月生成对账单
-        skipped_count = 0
-        generated_count = 0
-
-        for (customer, year_month), group_data in grouped:
-            # 创建客户文件夹
-            customer_dir = output_path / customer
-            customer_dir.mkdir(exist_ok=True)
-
-            # 生成文件名
-            statement_file = customer_dir / f'statement_{customer}_{year_month}.xlsx'
-
-            # 检查文件是否已存在
-            if statement_file.exists():
-                print(f"⏭️  对账单已存在，跳过: {statement_file.name}")
-                skipped_count += 1
-                continue
-
-            # 格式化年月显示
-            year_month_str = f'{year_month.year}年{year_month.month}月'
-
-            # 生成对账单
-            create_statement(
-                group_data,
-                customer_name=customer,
-                year_month=year_month_str,
-                output_file=str(statement_file)
-            )
-            generated_count += 1
+        generated_count, skipped_count = generate_statements(
+            df_all,
+            output_dir=output_dir,
+            workers=os.cpu_count()
+        )
 
         print()
         print("=" * 60)
@@ -129,4 +98,5 @@ def main():
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     main()
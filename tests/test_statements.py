@@ -0,0 +1,69 @@
+"""
+对账单增量生成的测试：送货单删除或改到其他客户月份后，旧的对账单和清单记录被删除
+
+在项目根目录运行：
+    uv run python -m unittest discover -s tests
+"""
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from merge_delivery_orders import build_detail_frame, generate_statements, prepare_statement_data
+
+
+def _row(customer, date, file_name, name='货品A', quantity=10.0, price=2.5):
+    return {'货名': name, '规格': '规格1', '数量': quantity, '单位': '个', '单价': price,
+            '金额': quantity * price, '客户': customer, '日期': date, '文件': file_name}
+
+
+class StaleStatementTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.output_dir = Path(self._tmp.name)
+        self.events = []
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def generate(self, rows):
+        df_all = prepare_statement_data(build_detail_frame(rows))
+        return generate_statements(df_all, output_dir=self.output_dir, progress=self.events.append)
+
+    def manifest_keys(self):
+        with open(self.output_dir / '.statement_manifest.json', encoding='utf-8') as f:
+            return set(json.load(f)['statements'])
+
+    def removed_files(self):
+        return [event['item']['file'] for event in self.events
+                if event['item'] and event['item'].get('status') == 'removed']
+
+    def test_deleted_note_removes_statement(self):
+        rows = [_row('客户0010', '2023-05-08', 'a.xlsx'), _row('客户0010', '2023-06-02', 'b.xlsx'),
+                _row('客户0011', '2023-05-09', 'c.xlsx')]
+        self.assertEqual(self.generate(rows), (3, 0))
+        stale = self.output_dir / '客户0010' / 'statement_客户0010_2023-05.xlsx'
+        self.assertTrue(stale.exists())
+
+        # 客户0010在2023-05月唯一的送货单被删除
+        self.events.clear()
+        self.assertEqual(self.generate(rows[1:]), (0, 2))
+        self.assertFalse(stale.exists())
+        self.assertEqual(self.manifest_keys(), {'客户0010/statement_客户0010_2023-06.xlsx',
+                                                '客户0011/statement_客户0011_2023-05.xlsx'})
+        self.assertEqual(self.removed_files(), [str(stale)])
+
+    def test_corrected_customer_removes_statement_and_folder(self):
+        rows = [_row('客户0010', '2023-05-08', 'a.xlsx'), _row('客户0011', '2023-05-09', 'c.xlsx')]
+        self.generate(rows)
+
+        # 送货单更正后改到了另一个客户，原客户没有其他对账单
+        rows[0] = _row('客户0011', '2023-05-08', 'a.xlsx')
+        self.assertEqual(self.generate(rows), (1, 0))
+        self.assertFalse((self.output_dir / '客户0010').exists())
+        self.assertEqual(self.manifest_keys(), {'客户0011/statement_客户0011_2023-05.xlsx'})
+
+
+if __name__ == '__main__':
+    unittest.main()
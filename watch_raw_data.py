@@ -0,0 +1,251 @@
+"""
+监视原始数据文件夹，送货单新增、修改或删除后自动更新合并文件和对账单
+
+Linux上使用inotify（通过ctypes调用libc），其他系统或inotify不可用时定时轮询。
+变化在debounce秒内没有新的变化后才开始更新，一次更新处理这段时间内的所有变化。
+借助提取缓存只解析变化的文件，借助对账单清单只重新生成受影响的对账单。
+每次更新的结果写入日志文件（默认为输出目录下的watch.log）。
+"""
+import argparse
+import ctypes
+import ctypes.util
+import logging
+import multiprocessing
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+
+from merge_delivery_orders import (
+    merge_delivery_orders, prepare_statement_data, generate_statements, print_progress, quiet_progress, ExtractCache,
+    is_excel_file_name, notify, scan_excel_files,
+)
+
+# inotify事件掩码（linux/inotify.h）
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """用inotify监视目录及其所有子目录，返回变化的送货单路径"""
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+    def __init__(self, root, progress=None):
+        libc_name = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or libc_name is None:
+            raise OSError('inotify不可用')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1失败')
+        self._dirs = {}
+        self.root = Path(root)
+        self.progress = progress or print_progress
+        for dir_path, _, _ in os.walk(self.root):
+            self._add_watch(dir_path)
+
+    def _add_watch(self, dir_path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dir_path), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'无法监视目录: {dir_path}')
+        self._dirs[wd] = Path(dir_path)
+
+    def wait(self, timeout):
+        """等待最多timeout秒（None表示一直等到有事件），返回这段时间内变化的送货单路径集合"""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changed = set()
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, name_len = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset + name_len].rstrip(b'\0'))
+            offset += name_len
+
+            if mask & IN_Q_OVERFLOW:
+                # 事件队列溢出，无法知道哪些文件变化了，重新扫描全部文件
+                changed.update(file_path for file_path, _ in scan_excel_files(self.root, progress=self.progress))
+                continue
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+
+            directory = self._dirs.get(wd)
+            if directory is None or not name:
+                continue
+            path = directory / name
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # 新目录：开始监视，并把其中已有的文件（监视开始前写入的）视为变化
+                    for dir_path, _, file_names in os.walk(path):
+                        try:
+                            self._add_watch(dir_path)
+                        except OSError as e:
+                            # 如监视数量达到上限（ENOSPC）或目录无法读取（EACCES）：不中断监视服务，
+                            # 目录中已有的送货单仍然更新，之后的变化要重新启动监视（或改用轮询）才能发现
+                            notify(self.progress, 'discovery', f"无法监视新目录 {dir_path}，"
+                                   f"其中以后的变化不会被自动发现: {e}", level='error', directory=str(dir_path))
+                        changed.update(Path(dir_path) / file_name for file_name in file_names
+                                       if is_excel_file_name(file_name))
+                elif mask & IN_MOVED_FROM:
+                    # 目录被移走，其中的送货单都已删除
+                    changed.add(path)
+            elif is_excel_file_name(name) and not (mask & IN_CREATE):
+                # 新建的文件在写完（IN_CLOSE_WRITE）后才处理
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """定时扫描目录，比较文件大小和修改时间，返回变化的送货单路径"""
+
+    def __init__(self, root, interval=2.0, progress=None):
+        self.root = Path(root)
+        self.interval = interval
+        self.progress = progress
+        self._snapshot = dict(scan_excel_files(self.root, progress=progress))
+
+    def wait(self, timeout):
+        """等待interval秒（timeout更短时等待timeout秒）后扫描，返回新增、修改或删除的送货单路径集合"""
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        snapshot = dict(scan_excel_files(self.root, progress=self.progress))
+        changed = {path for path, signature in snapshot.items() if self._snapshot.get(path) != signature}
+        changed.update(self._snapshot.keys() - snapshot.keys())
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+def create_watcher(raw_data_dir, poll_interval=2.0, use_inotify=True, progress=None):
+    """优先使用inotify，不可用时退回到轮询；progress接收重新扫描时无法读取目录的错误事件"""
+    if use_inotify:
+        try:
+            return InotifyWatcher(raw_data_dir, progress=progress)
+        except (OSError, AttributeError):
+            # AttributeError: libc中没有inotify函数（非Linux系统）
+            pass
+    return PollingWatcher(raw_data_dir, interval=poll_interval, progress=progress)
+
+
+def update_outputs(raw_data_dir, output_dir, cache, workers=1, progress=None):
+    """更新合并文件和受影响的对账单，返回(新生成数量, 跳过数量)；没有数据时返回None"""
+    output_file = os.path.join(output_dir, 'merged_delivery_orders.xlsx')
+    df_summary, df_all = merge_delivery_orders(raw_data_dir=raw_data_dir, output_file=output_file,
+                                               workers=workers, return_detail=True,
+                                               progress=progress, cache=cache)
+    if df_all is None:
+        return None
+    df_all = prepare_statement_data(df_all)
+    return generate_statements(df_all, output_dir=output_dir, workers=workers, progress=progress)
+
+
+def watch(raw_data_dir='raw-data', output_dir='output', debounce=2.0, poll_interval=2.0,
+          workers=1, use_inotify=True, progress=None, logger=None):
+    """持续监视raw_data_dir，送货单变化后更新输出；启动时先更新一次"""
+    logger = logger or logging.getLogger('watch_raw_data')
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    # 缓存在多次更新之间保留在内存中
+    cache = ExtractCache(Path(output_dir) / '.extract_cache.pkl')
+
+    def run_update(reason):
+        start = time.perf_counter()
+        try:
+            result = update_outputs(raw_data_dir, output_dir, cache, workers=workers, progress=progress)
+        except Exception:
+            logger.exception(f"更新失败（{reason}）")
+            return
+        seconds = time.perf_counter() - start
+        if result is None:
+            logger.warning(f"更新完成（{reason}）：没有找到任何数据，用时 {seconds:.1f} 秒")
+        else:
+            generated_count, skipped_count = result
+            logger.info(f"更新完成（{reason}）：解析 {cache.misses} 个文件，新生成 {generated_count} 个对账单，"
+                        f"{skipped_count} 个未变化，用时 {seconds:.1f} 秒")
+
+    run_update('启动')
+
+    watcher = create_watcher(raw_data_dir, poll_interval=poll_interval, use_inotify=use_inotify,
+                             progress=progress)
+    logger.info(f"开始监视 {raw_data_dir}（{'inotify' if isinstance(watcher, InotifyWatcher) else '轮询'}）")
+    pending = set()
+    last_change = None
+    try:
+        while True:
+            # 有待处理的变化时，等到debounce秒内没有新的变化再更新
+            timeout = None if last_change is None else max(0.0, last_change + debounce - time.monotonic())
+            changed = watcher.wait(timeout)
+            if changed:
+                pending.update(changed)
+                last_change = time.monotonic()
+            elif last_change is not None and time.monotonic() - last_change >= debounce:
+                names = sorted(str(path) for path in pending)
+                logger.info(f"检测到 {len(names)} 个文件变化: {', '.join(names[:5])}"
+                            f"{' 等' if len(names) > 5 else ''}")
+                pending.clear()
+                last_change = None
+                run_update(f"{len(names)} 个文件变化")
+    finally:
+        watcher.close()
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    parser = argparse.ArgumentParser(description='监视原始数据文件夹，自动更新合并文件和对账单')
+    parser.add_argument('--raw-data', default='raw-data', help='原始数据文件夹（默认: raw-data）')
+    parser.add_argument('--output', default='output', help='输出文件夹（默认: output）')
+    parser.add_argument('--debounce', type=float, default=2.0,
+                        help='最后一次变化后等待多少秒再更新（默认: 2）')
+    parser.add_argument('--poll-interval', type=float, default=2.0,
+                        help='不能使用inotify时的轮询间隔秒数（默认: 2）')
+    parser.add_argument('--polling', action='store_true', help='不使用inotify，总是轮询')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='并行提取数据和生成对账单的进程数（默认: CPU核心数）')
+    parser.add_argument('--log', help='日志文件（默认: 输出文件夹下的watch.log）')
+    parser.add_argument('--verbose', action='store_true', help='显示每个文件和对账单的处理过程')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.raw_data):
+        print(f"原始数据文件夹不存在: {args.raw_data}")
+        sys.exit(1)
+
+    Path(args.output).mkdir(parents=True, exist_ok=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s',
+        handlers=[logging.FileHandler(args.log or Path(args.output) / 'watch.log', encoding='utf-8'),
+                  logging.StreamHandler()],
+    )
+
+    try:
+        watch(raw_data_dir=args.raw_data, output_dir=args.output, debounce=args.debounce,
+              poll_interval=args.poll_interval, workers=args.workers, use_inotify=not args.polling,
+              progress=print_progress if args.verbose else quiet_progress)
+    except KeyboardInterrupt:
+        logging.getLogger('watch_raw_data').info("停止监视")